@@ -20,5 +20,8 @@ def on_unload(server: MCDR.PluginServerInterface):
 def on_server_start(server: MCDR.PluginServerInterface):
 	api.on_server_start(server)
 
+def on_server_stop(server: MCDR.PluginServerInterface, code: int):
+	api.on_server_stop(server, code)
+
 def on_info(server: MCDR.ServerInterface, info: MCDR.Info):
   api.on_info(server, info)
@@ -1,6 +1,7 @@
 
 import os
 import time
+import shutil
 
 import mcdreforged.api.all as MCDR
 from .utils import *
@@ -8,7 +9,7 @@ from . import globals as GL
 from .objects import *
 
 __all__ = [
-	'make_backup', 'restore_backup'
+	'make_backup', 'restore_backup', 'migrate_backups'
 ]
 
 game_saved_callback = None
@@ -42,9 +43,20 @@ def _timed_make_backup():
 	source = MCDR.ServerInterface.get_instance().get_plugin_command_source()
 	make_backup(source, time.strftime('SMB timed backup: %Y-%m-%d %H:%M:%S', time.localtime()), timed=True)
 
+def _collect_failed(e: Exception):
+	log_error('Deleting removed backup data failed:', str(e), exc_info=e)
+
 @GL.on_load_call
 def on_load(server: MCDR.PluginServerInterface):
 	_flush_backup_timer()
+	GL.Manager.configure(on_error=_collect_failed)
+	GL.Manager.throttle.running = server.is_server_running()
+	if GL.Config.watch_changes:
+		try:
+			if not GL.Manager.watch(server.get_mcdr_config()['working_directory'], GL.Config.backup_needs):
+				log_info('File watching is not supported here, every backup scans the whole world')
+		except OSError as e:
+			log_info('Cannot watch the world for changes, every backup scans the whole world: {}'.format(e))
 
 @GL.on_unload_call
 def on_unload(server: MCDR.PluginServerInterface):
@@ -52,9 +64,15 @@ def on_unload(server: MCDR.PluginServerInterface):
 	if backup_timer is not None:
 		backup_timer.cancel()
 		backup_timer = None
+	if GL.Manager is not None:
+		GL.Manager.close()
 
 def on_server_start(server: MCDR.PluginServerInterface):
 	_clear_job()
+	GL.Manager.throttle.running = True
+
+def on_server_stop(server: MCDR.PluginServerInterface, code: int):
+	GL.Manager.throttle.running = False
 
 @new_job('clean up backup')
 def clean_backup():
@@ -63,17 +81,24 @@ def clean_backup():
 		return
 	broadcast_message('Cleaning backup...')
 	start_time = time.time()
-	before_size = get_total_size(GL.Config.backup_path)
+	count: int = 0
+	# the backups are only moved into the trash here, deleting them and their data is left to the collector
 	while len(GL.Manager.index.fulln) > GL.Config.full_backup_limit:
 		bid = GL.Manager.index.pop_outdated()
 		if bid is None:
 			break
 		bk = GL.Manager.load(bid)
 		broadcast_message(tr('clean.outdated', id=bk.id, comment=bk.comment, date=bk.strftime))
-		bk.remove()
+		count += len(bk.remove())
 	used_time = time.time() - start_time
-	free_size = before_size - get_total_size(GL.Config.backup_path)
-	broadcast_message(tr('clean.finish', t=used_time, free=format_size(free_size)))
+	broadcast_message(tr('clean.finish', t=used_time, count=count))
+
+@new_job('consolidate backup')
+def consolidate_backup(bk: Backup):
+	start_time = time.time()
+	if GL.Manager.consolidate(bk):
+		used_time = time.time() - start_time
+		broadcast_message(tr('consolidated', id=bk.id, comment=bk.comment, date=bk.strftime, t=used_time))
 
 @new_job('make backup')
 def make_backup(source: MCDR.CommandSource, comment: str, mode: BackupMode = None, *, timed: bool = False, clean: bool = True):
@@ -107,16 +132,26 @@ def make_backup(source: MCDR.CommandSource, comment: str, mode: BackupMode = Non
 			outdate = int(time.time() // 60 + outdate) if outdate > 0 else 0
 		else:
 			outdate = 1
+		staged: bool = GL.Config.snapshot_backup and server.is_server_startup()
 		backup = GL.Manager.create(mode, comment, outdate,
-			source.get_server().get_mcdr_config()['working_directory'], GL.Config.backup_needs, GL.Config.backup_ignores, saved=False)
+			source.get_server().get_mcdr_config()['working_directory'], GL.Config.backup_needs, GL.Config.backup_ignores, saved=False,
+			rehash=GL.Config.force_rehash, staged=staged)
+		def resume_saving():
+			if server.is_server_startup():
+				for _ in map(server.execute, GL.Config.after_backup): pass
+				send_message(source, tr('make.resumed', t=time.time() - start_time), log=True)
+		if staged:
+			resume_saving()
 		send_message(source, tr('make.saving', date=backup.strftime, comment=backup.comment), log=True)
 		backup.save()
 		send_message(source, tr('make.saved', date=backup.strftime, comment=backup.comment), log=True)
-		if server.is_server_startup():
-			for _ in map(server.execute, GL.Config.after_backup): pass
+		if not staged:
+			resume_saving()
 		used_time = time.time() - start_time
-		broadcast_message(tr('make.finish', t=used_time, use=format_size(get_total_size(os.path.join(GL.Config.backup_path, backup.id)))))
+		broadcast_message(tr('make.finish', t=used_time, use=format_size(backup.disk_size)))
 		_flush_backup_timer()
+		if GL.Config.consolidate_depth > 0 and backup.z_index >= GL.Config.consolidate_depth:
+			swap_job_call(consolidate_backup, backup)
 		if clean and mode == BackupMode.FULL and GL.Config.full_backup_limit > 0 and len(GL.Manager.index.fulln) > GL.Config.full_backup_limit:
 			broadcast_message(tr('clean.auto'))
 			swap_job_call(clean_backup)
@@ -142,13 +177,43 @@ def restore_backup(source: MCDR.CommandSource, bid: str):
 		send_message(source, MCDR.RText(tr('error.not_found', bid), color=MCDR.RColor.red))
 		return False
 	server = source.get_server()
+	base: str = server.get_mcdr_config()['working_directory']
+
+	if GL.Config.staged_restore:
+		staging: str = os.path.join(base, '.smb_restore')
+		log_info('Preparing restore...')
+		shutil.rmtree(staging, ignore_errors=True)
+		shutil.rmtree(GL.Config.overwrite_path, ignore_errors=True)
+		try:
+			bk.restore(staging, GL.Config.backup_needs, GL.Config.backup_ignores)
+			broadcast_message('Stopping the server')
+			server.stop()
+			server.wait_for_start()
+			GL.Manager.throttle.running = False
+			# the world moved into overwrite_path is replaced by the next restore, keep it as a backup too
+			safety = GL.Manager.create(BackupMode.INCREMENTAL, f'Server before restore({bid}) backup', 1,
+				base, GL.Config.backup_needs, GL.Config.backup_ignores)
+			send_message(source, tr('make.saved', date=safety.strftime, comment=safety.comment), log=True)
+			log_info('Restoring...')
+			swap_dirs(base, staging, GL.Config.overwrite_path, GL.Config.backup_needs, GL.Config.backup_ignores)
+		finally:
+			shutil.rmtree(staging, ignore_errors=True)
+		log_info('Starting the server')
+		server.start()
+		return True
 
 	broadcast_message('Stopping the server')
 	server.stop()
 	server.wait_for_start()
-	swap_job_call(make_backup, source, f'Server before restore({bid}) backup', mode=BackupMode.FULL, clean=False)
+	# the server is stopped, the events may arrive late
+	GL.Manager.throttle.running = False
+	# an incremental backup on top of the last one, with the stat cache and the shared chunks
+	# it only costs a scan and a small manifest when little changed since then
+	safety = GL.Manager.create(BackupMode.INCREMENTAL, f'Server before restore({bid}) backup', 1,
+		base, GL.Config.backup_needs, GL.Config.backup_ignores)
+	send_message(source, tr('make.saved', date=safety.strftime, comment=safety.comment), log=True)
 	log_info('Restoring...')
-	bk.restore(server.get_mcdr_config()['working_directory'], GL.Config.backup_needs, GL.Config.backup_ignores)
+	bk.restore(base, GL.Config.backup_needs, GL.Config.backup_ignores, differential=GL.Config.differential_restore)
 	log_info('Starting the server')
 	server.start()
 
@@ -168,3 +233,12 @@ def remove_backup(source: MCDR.CommandSource, bid: str):
 	bk.remove()
 	broadcast_message('<{0}> removed backup {1}({2})'.format(source, date=bk.strftime, comment=bk.comment))
 	return True
+
+@new_job('migrate')
+def migrate_backups(source: MCDR.CommandSource):
+	broadcast_message(tr('migrate.start'))
+	start_time = time.time()
+	count, moved = GL.Manager.migrate(
+		lambda bk: send_message(source, tr('migrate.converted', id=bk.id, comment=bk.comment, date=bk.strftime), log=True))
+	used_time = time.time() - start_time
+	broadcast_message(tr('migrate.finish', t=used_time, count=count, moved=moved))
@@ -0,0 +1,95 @@
+
+import zlib
+import lzma
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+try:
+	import lz4.frame as lz4
+except ImportError:
+	lz4 = None
+
+__all__ = [
+	'CODEC_NONE', 'CODEC_ZLIB', 'CODEC_LZMA', 'CODEC_ZSTD', 'CODEC_LZ4',
+	'codec_by_name', 'compress', 'decompress', 'encode_object'
+]
+
+# the ids are stored with every object, never reuse one
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_ZSTD = 3
+CODEC_LZ4 = 4
+
+_NAMES = {
+	'none': CODEC_NONE,
+	'zlib': CODEC_ZLIB,
+	'lzma': CODEC_LZMA,
+	'zstd': CODEC_ZSTD,
+	'lz4': CODEC_LZ4,
+}
+
+MIN_SIZE = 512 # smaller objects are not worth a codec
+PROBE_SIZE = 4096
+PROBE_RATIO = 0.9 # the probe has to shrink below this to try the whole object
+KEEP_RATIO = 0.95 # and the whole object below this to keep the compressed data
+
+def codec_by_name(name: str):
+	codec = _NAMES.get(name.lower(), None)
+	if codec is None:
+		raise ValueError('Unknown codec ' + name)
+	if codec == CODEC_ZSTD and zstandard is None:
+		raise ValueError('Codec zstd needs the zstandard package')
+	if codec == CODEC_LZ4 and lz4 is None:
+		raise ValueError('Codec lz4 needs the lz4 package')
+	return codec
+
+def compress(data, codec: int):
+	if codec == CODEC_ZLIB:
+		return zlib.compress(data, 6)
+	if codec == CODEC_LZMA:
+		return lzma.compress(data, preset=1)
+	if codec == CODEC_ZSTD:
+		return zstandard.ZstdCompressor(level=3).compress(data)
+	if codec == CODEC_LZ4:
+		return lz4.compress(data)
+	return data
+
+def decompress(data, codec: int):
+	if codec == CODEC_NONE:
+		return data
+	if codec == CODEC_ZLIB:
+		return zlib.decompress(data)
+	if codec == CODEC_LZMA:
+		return lzma.decompress(data)
+	if codec == CODEC_ZSTD:
+		if zstandard is None:
+			raise RuntimeError('Object is compressed with zstd but the zstandard package is not installed')
+		return zstandard.ZstdDecompressor().decompress(data)
+	if codec == CODEC_LZ4:
+		if lz4 is None:
+			raise RuntimeError('Object is compressed with lz4 but the lz4 package is not installed')
+		return lz4.decompress(data)
+	raise ValueError('Unknown codec id {}'.format(codec))
+
+def _probe(data):
+	# compressing a few small samples at the fastest level is much cheaper than the whole object,
+	# already compressed data (region files, pngs, ...) doesn't shrink and is skipped here
+	n = len(data)
+	if n <= PROBE_SIZE * 2:
+		sample = bytes(data)
+	else:
+		m = n // 2
+		sample = bytes(data[:PROBE_SIZE]) + bytes(data[m:m + PROBE_SIZE])
+	return len(zlib.compress(sample, 1)) < len(sample) * PROBE_RATIO
+
+def encode_object(data, codec: int):
+	# returns the codec actually used and the bytes to store
+	if codec != CODEC_NONE and len(data) >= MIN_SIZE and _probe(data):
+		b = compress(data, codec)
+		if len(b) < len(data) * KEEP_RATIO:
+			return codec, b
+	return CODEC_NONE, data
@@ -1,11 +1,11 @@
 
-import os
 import time
 
 import mcdreforged.api.all as MCDR
 from .utils import *
 from . import globals as GL
 from .objects import *
+from .digest import *
 from . import api
 
 Prefix = '!!smb'
@@ -38,6 +38,8 @@ def register(server: MCDR.PluginServerInterface):
 		then(GL.Config.literal('remove').
 			then(MCDR.Text('id').runs(lambda src, ctx: command_remove(src, ctx['id'])).
 				then(MCDR.Boolean('force').runs(lambda src, ctx: command_remove(src, ctx['id'], ctx['force']))))).
+		then(GL.Config.literal('migrate').runs(command_migrate)).
+		then(GL.Config.literal('benchmark').runs(command_benchmark)).
 		then(GL.Config.literal('confirm').runs(command_confirm)).
 		then(GL.Config.literal('abort').runs(command_abort)).
 		then(GL.Config.literal('reload').runs(command_config_load)).
@@ -53,13 +55,12 @@ def command_status(source: MCDR.CommandSource):
 	lc = 'None' if lb is None else new_command(
 		f'{Prefix} restore {lb.id}',
 		f'{lb.id}: {lb.strftime}({lb.comment})')
-	bs = 0
-	if os.path.exists(GL.Config.backup_path):
-		bs = get_total_size(GL.Config.backup_path)
 	send_block_message(source,
 		'Backup path: ' + GL.Config.backup_path,
-		'  Size: ' + format_size(bs),
+		'  Size: ' + format_size(GL.Manager.index.total),
 		'  Count: ' + str(len(GL.Manager.listID())),
+		'Backup cache: {0} loaded, about {1}, {2} hits, {3} misses'.format(
+			len(GL.Manager.cache), format_size(GL.Manager.cache.memory), GL.Manager.cache.hits, GL.Manager.cache.misses),
 		join_rtext('Timed backup:', MCDR.RText('disabled' if api.backup_timer is None else 'enabled', color=MCDR.RColor.yellow)),
 		join_rtext('Last backup:', lc)
 	)
@@ -75,7 +76,8 @@ def command_list_backup(source: MCDR.CommandSource, limit: int):
 				id=b.id,
 				comment=b.comment,
 				date=b.strftime,
-				size=format_size(get_total_size(os.path.join(GL.Config.backup_path, b.id)))
+				size=format_size(b.disk_size),
+				logical=format_size(b.size)
 			)),
 			': ' + b.comment))
 	send_message(source, GL.BIG_BLOCK_AFTER)
@@ -93,7 +95,8 @@ def command_query_backup(source: MCDR.CommandSource, bid: str):
 			id=bk.id,
 			comment=bk.comment,
 			date=bk.strftime,
-			size=format_size(get_total_size(os.path.join(GL.Config.backup_path, bk.id)))
+			size=format_size(bk.disk_size),
+			logical=format_size(bk.size)
 		),
 		join_rtext(
 			new_command(f'{Prefix} restore {bk.id}', f'[{tr("restore.word")}]'),
@@ -155,7 +158,8 @@ def command_restore(source: MCDR.CommandSource, bid: str, force: bool = False):
 			id=bk.id,
 			comment=bk.comment,
 			date=bk.strftime,
-			size=format_size(get_total_size(os.path.join(GL.Config.backup_path, bk.id)))
+			size=format_size(bk.disk_size),
+			logical=format_size(bk.size)
 		)))
 	send_message(source, tr('word.run'), new_command(f'{Prefix} confirm'), tr('to_confirm') + ',',
 		tr('word.run'), new_command(f'{Prefix} abort'), tr('word.to_cancel'))
@@ -185,11 +189,23 @@ def command_remove(source: MCDR.CommandSource, bid: str, force: bool = False):
 			id=bk.id,
 			comment=bk.comment,
 			date=bk.strftime,
-			size=format_size(get_total_size(os.path.join(GL.Config.backup_path, bk.id)))
+			size=format_size(bk.disk_size),
+			logical=format_size(bk.size)
 		)))
 	send_message(source, tr('word.run'), new_command(f'{Prefix} confirm'), tr('to_confirm') + ',',
 		tr('word.run'), new_command(f'{Prefix} abort'), tr('word.to_cancel'))
 
+@new_thread
+def command_migrate(source: MCDR.CommandSource):
+	api.migrate_backups(source)
+
+@new_thread
+def command_benchmark(source: MCDR.CommandSource):
+	send_message(source, tr('benchmark.start'))
+	for name, speed in benchmark():
+		send_message(source, tr('benchmark.result', name=name, speed=format_size(int(speed)),
+			current=' <-' if hash_by_name(name) == GL.Manager.algo else ''))
+
 def command_confirm(source: MCDR.CommandSource):
 	confirm_map.pop(source.player if source.is_player else '', (lambda s: send_message(s, tr('word.no_action')), 0))[0](source)
 
@@ -0,0 +1,102 @@
+
+import os
+import time
+import hashlib
+
+try:
+	import xxhash
+except ImportError:
+	xxhash = None
+
+__all__ = [
+	'HASH_SHA256', 'HASH_BLAKE2B', 'HASH_BLAKE2S', 'HASH_XXH3',
+	'hash_by_name', 'available_hashes', 'FileHasher', 'file_hash', 'benchmark'
+]
+
+# the ids are stored in the backup headers, never reuse one
+HASH_SHA256 = 0 # what every backup before format 4 uses
+HASH_BLAKE2B = 1
+HASH_BLAKE2S = 2
+# xxh3-128 only hashed whole files, next to the blake2b chunk keys, which made it slower than blake2b alone.
+# It can't be chosen anymore, the backups made with it are still read
+HASH_XXH3 = 3
+
+_NAMES = {
+	'sha256': HASH_SHA256,
+	'blake2b': HASH_BLAKE2B,
+	'blake2s': HASH_BLAKE2S,
+}
+
+def _sha256(data):
+	return hashlib.sha256(data).digest()
+
+def _blake2b(data):
+	return hashlib.blake2b(data, digest_size=32).digest()
+
+def _blake2s(data):
+	return hashlib.blake2s(data).digest()
+
+_KEYS = {
+	HASH_SHA256: _sha256,
+	HASH_BLAKE2B: _blake2b,
+	HASH_BLAKE2S: _blake2s,
+	HASH_XXH3: _blake2b,
+}
+
+def available_hashes():
+	return list(_NAMES.keys())
+
+def hash_by_name(name: str):
+	algo = _NAMES.get(name.lower(), None)
+	if algo is None:
+		raise ValueError('Unknown hash algorithm ' + name)
+	return algo
+
+class FileHasher:
+	# Computes the chunk keys and the hash of a whole file in one pass over the chunks.
+	# sha256 keeps hashing the file content like older versions did. With blake2 the file hash
+	# is the key of its only chunk, or the hash of its chunk keys, so every byte is hashed once.
+	def __init__(self, algo: int = HASH_SHA256):
+		if algo == HASH_XXH3 and xxhash is None:
+			raise RuntimeError('Backup is hashed with xxh3 but the xxhash package is not installed')
+		self._algo = algo
+		self.key = _KEYS[algo]
+		self._h = hashlib.sha256() if algo == HASH_SHA256 else xxhash.xxh3_128() if algo == HASH_XXH3 else None
+		self._keys = []
+
+	def update(self, data, key: bytes = None):
+		if self._h is not None:
+			self._h.update(data)
+		else:
+			self._keys.append(self.key(data) if key is None else key)
+
+	def digest(self):
+		if self._algo == HASH_XXH3:
+			return self._h.digest() + bytes(16)
+		if self._h is not None:
+			return self._h.digest()
+		if len(self._keys) == 1:
+			return self._keys[0]
+		return self.key(b''.join(self._keys))
+
+def file_hash(rd, algo: int, splitter):
+	# the hash put_stream would record for the content of rd, splitter has to be the one it used
+	h = FileHasher(algo)
+	for b in splitter(rd):
+		h.update(b)
+	return h.digest()
+
+def benchmark(size: int = 64 * 1024 * 1024, chunk: int = 1024 * 1024):
+	# bytes per second put_stream hashes with every available algorithm, chunk keys included
+	data = memoryview(os.urandom(size))
+	res = []
+	for name in available_hashes():
+		algo = _NAMES[name]
+		start = time.perf_counter()
+		h = FileHasher(algo)
+		for o in range(0, size, chunk):
+			b = data[o:o + chunk]
+			h.update(b, h.key(b))
+		h.digest()
+		res.append((name, size / max(time.perf_counter() - start, 1e-9)))
+	return res
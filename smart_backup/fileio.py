@@ -0,0 +1,121 @@
+
+import os
+import sys
+import errno
+import threading
+
+__all__ = [
+	'BUFFER_SIZE', 'get_buffer', 'read_full', 'write_full', 'copy_range', 'clone_file', 'copy_file', 'fsync_dir'
+]
+
+BUFFER_SIZE = 1024 * 1024 # 1MB
+FICLONE = 0x40049409 # _IOW(0x94, 9, int)
+
+_local = threading.local()
+
+def get_buffer(size: int = BUFFER_SIZE):
+	# every thread reuses its own buffer instead of allocating one per read
+	buf = getattr(_local, 'buffer', None)
+	if buf is None or len(buf) < size:
+		buf = _local.buffer = bytearray(max(size, BUFFER_SIZE))
+	return memoryview(buf)[:size]
+
+def read_full(rd, mv: memoryview):
+	n: int = 0
+	while n < len(mv):
+		m = rd.readinto(mv[n:])
+		if not m:
+			break
+		n += m
+	return n
+
+def write_full(fd: int, data, offset: int = None):
+	v = memoryview(data)
+	while v:
+		n = os.write(fd, v) if offset is None else os.pwrite(fd, v, offset)
+		v = v[n:]
+		if offset is not None:
+			offset += n
+
+_kernel_copy = {'copy_file_range': hasattr(os, 'copy_file_range'), 'sendfile': sys.platform.startswith('linux')}
+
+def copy_range(src: int, dst: int, count: int = -1, offset: int = None):
+	# copy count bytes (or until EOF when count is negative) from the src fd to the
+	# current position of the dst fd, letting the kernel move the data when it can.
+	# With offset the src fd is read positionally and its file position is not used,
+	# so several threads can copy out of the same src fd.
+	total: int = 0
+	def remain():
+		return BUFFER_SIZE if count < 0 else min(count - total, BUFFER_SIZE)
+	def pos():
+		return None if offset is None else offset + total
+	if _kernel_copy['copy_file_range']:
+		try:
+			while count < 0 or total < count:
+				n = os.copy_file_range(src, dst, remain(), pos())
+				if n == 0:
+					return total
+				total += n
+			return total
+		except OSError as err:
+			if total > 0 or not _is_unsupported(err):
+				raise
+			if err.errno == errno.ENOSYS:
+				_kernel_copy['copy_file_range'] = False
+	if _kernel_copy['sendfile']:
+		try:
+			while count < 0 or total < count:
+				n = os.sendfile(dst, src, pos(), remain())
+				if n == 0:
+					return total
+				total += n
+			return total
+		except OSError as err:
+			if total > 0 or not _is_unsupported(err):
+				raise
+	mv = get_buffer()
+	while count < 0 or total < count:
+		b = mv[:remain()]
+		n = os.readv(src, [b]) if offset is None else os.preadv(src, [b], pos())
+		if n == 0:
+			break
+		v = mv[:n]
+		while v:
+			v = v[os.write(dst, v):]
+		total += n
+	return total
+
+def _is_unsupported(err: OSError):
+	return err.errno in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+
+def clone_file(src: int, dst: int):
+	# share the extents of src with dst on filesystems with reflink support (btrfs, xfs, ...)
+	try:
+		import fcntl
+		fcntl.ioctl(dst, FICLONE, src)
+		return True
+	except (ImportError, OSError):
+		return False
+
+def fsync_dir(path: str):
+	# make the entries created or renamed in path durable, directories can't be opened on every platform
+	try:
+		fd = os.open(path, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def copy_file(src: str, dst: str, *, reflink: bool = True):
+	sfd = os.open(src, os.O_RDONLY)
+	try:
+		dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+		try:
+			if not reflink or not clone_file(sfd, dfd):
+				copy_range(sfd, dfd)
+		finally:
+			os.close(dfd)
+	finally:
+		os.close(sfd)
@@ -35,10 +35,45 @@ class SMBConfig(MCDR.Serializable):
 	backup_path: str = './smt_backups'
 	overwrite_path: str = './smt_backup_overwrite'
 	backup_needs: List[str] = ['world']
+	# `name`, `dir/name` or `/anchored/path`, with `*`, `?` and `**` globs. A trailing `/` only matches directories
 	backup_ignores: List[str] = ['session.lock']
 	befor_backup: List[str] = ['save-off', 'save-all flush']
 	start_backup_trigger_info: str = r'Saved the (?:game|world)'
 	after_backup: List[str] = ['save-on']
+	# ignore the stat cache and read every file again to detect changes
+	force_rehash: bool = False
+	# threads used to hash and copy files, 0 means pick by cpu count
+	worker_count: int = 0
+	# copy changed files to a staging directory and run after_backup before hashing them
+	snapshot_backup: bool = False
+	# only rewrite the files that differ from the backup when restoring
+	differential_restore: bool = True
+	# restore into a directory next to the world while the server is running and swap it in after stopping,
+	# the replaced world is kept in overwrite_path. This needs the disk space of another copy of the world
+	staged_restore: bool = False
+	# a backup this many backups away from its full backup is rewritten into a full one, 0 means never
+	consolidate_depth: int = 8
+	# the most backups kept loaded in memory, and the memory they may take in MB (0 means no limit)
+	backup_cache_size: int = 32
+	backup_cache_memory: int = 256
+	# compress new backup data with none, zlib, lzma, or zstd and lz4 when their packages are installed.
+	# Data that is already compressed (like region files) is detected and stored as is
+	compression: str = 'zlib'
+	# hash of new backups: sha256, blake2b or blake2s. Data stored under another algorithm isn't shared with the new one,
+	# so changing this stores everything once more until the older backups are cleaned up
+	hash_algorithm: str = 'sha256'
+	# removed backups and unreferenced data are deleted by a background thread, it pauses this long (in ms)
+	# after every deleted backup and rewritten pack so it doesn't starve the server's disk
+	gc_pause: int = 50
+	# disk budget of backups in MB/s and operations/s while the server runs, and while it's stopped (restoring), 0 means no limit
+	io_rate_running: int = 0
+	io_ops_running: int = 0
+	io_rate_stopped: int = 0
+	io_ops_stopped: int = 0
+	# run the backup workers at the lowest cpu and disk priority while the server runs (linux only)
+	low_priority: bool = True
+	# record the changed directories with inotify (linux only) so incremental backups don't have to scan the whole world
+	watch_changes: bool = True
 	# 0:guest 1:user 2:helper 3:admin 4:owner
 	minimum_permission_level: Dict[str, int] = {
 		'help':     0,
@@ -49,6 +84,8 @@ class SMBConfig(MCDR.Serializable):
 		'makefull': 3,
 		'rm':       3,
 		'restore':  3,
+		'migrate':  3,
+		'benchmark': 3,
 		'confirm':  1,
 		'abort':    1,
 		'reload':   3,
@@ -116,7 +153,27 @@ class SMBConfig(MCDR.Serializable):
 					cache = {} if oldConfig is None else oldConfig.cache
 		Config.cache = cache
 		if oldConfig is None or oldConfig.backup_path != Config.backup_path:
+			on_error = None
+			if Manager is not None:
+				Manager.close()
+				on_error = Manager.on_error
 			Manager = BackupManager(Config.backup_path)
+			Manager.configure(on_error=on_error)
+		Manager.configure(workers=Config.worker_count,
+			cache_size=Config.backup_cache_size, cache_memory=Config.backup_cache_memory * 1024 * 1024,
+			gc_pause=Config.gc_pause / 1000, low_priority=Config.low_priority,
+			io_running=(Config.io_rate_running * 1024 * 1024, Config.io_ops_running),
+			io_stopped=(Config.io_rate_stopped * 1024 * 1024, Config.io_ops_stopped))
+		try:
+			Manager.configure(compression=Config.compression)
+		except ValueError as e:
+			server.logger.warning('{}, new backup data will not be compressed'.format(e))
+			Manager.configure(compression='none')
+		try:
+			Manager.configure(hash_algorithm=Config.hash_algorithm)
+		except ValueError as e:
+			server.logger.warning('{}, new backups are hashed with sha256'.format(e))
+			Manager.configure(hash_algorithm='sha256')
 
 	def save(self, source: MCDR.CommandSource):
 		self._server.save_config_simple(self)
@@ -152,7 +209,9 @@ def init(server: MCDR.PluginServerInterface):
 		c(server)
 
 def destory(server: MCDR.PluginServerInterface):
-	global Manager
+	global Config, Manager
+	for c in on_unload_callbacks:
+		c(server)
 	if Config is not None:
 		Config.save(server.get_plugin_command_source())
 		Config = None
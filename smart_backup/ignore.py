@@ -0,0 +1,88 @@
+
+import re
+
+__all__ = [
+	'IgnoreMatcher'
+]
+
+class IgnoreMatcher:
+	# Compiles backup_ignores once. Rules are matched against paths relative to the working directory:
+	#   name         an entry with this name anywhere
+	#   a/b          a path ending with a/b
+	#   /a/b         exactly a/b (anchored)
+	#   rule/        only matches directories
+	# `*` and `?` don't cross a `/`, `**` does
+	def __init__(self, rules: list):
+		names, dnames = set(), set()
+		nglobs, dnglobs, pglobs, dpglobs = [], [], [], []
+		for r in rules:
+			r = r.strip()
+			dir_only = r.endswith('/')
+			r = r.rstrip('/')
+			if len(r) == 0:
+				continue
+			if r.startswith('/'):
+				(dpglobs if dir_only else pglobs).append('^' + _translate(r.lstrip('/')) + '$')
+			elif '/' in r:
+				(dpglobs if dir_only else pglobs).append('(?:^|/)' + _translate(r) + '$')
+			elif any(c in r for c in '*?['):
+				(dnglobs if dir_only else nglobs).append('^' + _translate(r) + '$')
+			else:
+				(dnames if dir_only else names).add(r)
+		self._names = names
+		self._dnames = dnames
+		self._name_re = _compile(nglobs)
+		self._dname_re = _compile(dnglobs)
+		self._path_re = _compile(pglobs)
+		self._dpath_re = _compile(dpglobs)
+
+	def ignored(self, parent: str, name: str, is_dir: bool = False):
+		if name in self._names or (self._name_re is not None and self._name_re.match(name)):
+			return True
+		if is_dir and (name in self._dnames or (self._dname_re is not None and self._dname_re.match(name))):
+			return True
+		if self._path_re is None and (not is_dir or self._dpath_re is None):
+			return False
+		path = parent + '/' + name if len(parent) > 0 else name
+		if self._path_re is not None and self._path_re.search(path):
+			return True
+		return is_dir and self._dpath_re is not None and self._dpath_re.search(path) is not None
+
+	def __call__(self, parent: str, name: str, is_dir: bool = False):
+		# True means the entry should be kept
+		return not self.ignored(parent, name, is_dir)
+
+def _compile(globs: list):
+	return re.compile('|'.join('(?:' + g + ')' for g in globs)) if len(globs) > 0 else None
+
+def _translate(glob: str):
+	i, n = 0, len(glob)
+	res = []
+	while i < n:
+		c = glob[i]
+		if c == '*':
+			if glob.startswith('**', i):
+				i += 2
+				if glob.startswith('/', i):
+					i += 1
+					res.append('(?:.*/)?')
+				else:
+					res.append('.*')
+				continue
+			res.append('[^/]*')
+		elif c == '?':
+			res.append('[^/]')
+		elif c == '[':
+			j = glob.find(']', i + 2)
+			if j < 0:
+				res.append('\\[')
+			else:
+				body = glob[i + 1:j]
+				if body.startswith('!'):
+					body = '^' + body[1:]
+				res.append('[' + body.replace('\\', '\\\\') + ']')
+				i = j
+		else:
+			res.append(re.escape(c))
+		i += 1
+	return ''.join(res)
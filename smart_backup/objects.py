@@ -1,21 +1,45 @@
 
 import io
 import os
+import sys
+import stat
+import types
+import errno
 import shutil
 import time
 import enum
-import hashlib
-import weakref
-import queue
+import collections
 import json
+import functools
+import threading
+import traceback
+
+from .fileio import *
+from .store import *
+from .codec import *
+from .digest import *
+from .region import *
+from .pool import *
+from .ignore import *
+from .watch import *
+from .throttle import *
 
 __all__ = [
-	'BackupNotFoundError',
+	'FORMAT_VERSION', 'BackupNotFoundError',
 	'ModifiedType', 'BackupMode',
-	'BackupFile', 'BackupDir', 'Backup',
-	'BackupIndex', 'BackupManager'
+	'ScanContext', 'BackupFile', 'BackupDir', 'Manifest', 'Backup',
+	'BackupIndex', 'StatCache', 'BackupCache', 'BackupManager',
+	'swap_dirs'
 ]
 
+# 1: file data is stored after the header of each .F file
+# 2: .F files reference chunks in the shared object store
+# 3: all entries are kept in one sorted manifest file, chunks are stored in pack files
+# 4: the header records the hash algorithm of the backup
+FORMAT_VERSION = 4
+
+TRASH_DIR = '.trash'
+
 class BackupNotFoundError(FileNotFoundError):
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
@@ -30,13 +54,111 @@ class BackupMode(int, enum.Enum):
 	INCREMENTAL = 1
 	DIFFERENTIAL = 2
 
+class ScanContext: pass
 class BackupFile: pass
 class BackupDir: pass
+class Manifest: pass
 class Backup: pass
+class StatCache: pass
+class BackupCache: pass
 class BackupManager: pass
 
+def _holding(call):
+	# the background collector leaves the store alone while a holding call runs
+	@functools.wraps(call)
+	def c(self, *args, **kwargs):
+		m = self._manager if isinstance(self, Backup) else self
+		m._hold()
+		try:
+			return call(self, *args, **kwargs)
+		finally:
+			m._unhold()
+	return c
+
+class ScanContext:
+	def __init__(self, filterc=lambda *a, **b: True, *, store: ObjectStore, prev: Backup = None, ref: Backup = None, statc: StatCache = None,
+		pool: WorkerPool = None, staging: str = None, dirty: DirtySet = None, algo: int = HASH_SHA256):
+		self.filterc = filterc
+		self.store = store
+		self.prev = prev
+		self.ref = ref
+		self.statc = statc
+		self.pool = pool
+		self.staging = staging
+		# only the changed directories are visited when set, the rest is taken as unchanged from prev
+		self.dirty = dirty
+		self.algo = algo
+
+	def submit(self, call, *args, **kwargs):
+		if self.pool is None:
+			return call(*args, **kwargs)
+		return self.pool.submit(call, *args, **kwargs)
+
+	def stage(self, path: str, *pt):
+		# take a private copy that the server cannot change anymore once saving is resumed
+		dst = os.path.join(self.staging, *pt)
+		os.makedirs(os.path.dirname(dst), exist_ok=True)
+		self.store.throttle.io(os.path.getsize(path) * 2, 2)
+		copy_file(path, dst)
+		return dst
+
+	def run_deferred(self, files: dict):
+		for n, f in files.items():
+			f = resolve(f)
+			if isinstance(f, functools.partial):
+				f = self.submit(f)
+			elif isinstance(f, BackupDir):
+				self.run_deferred(f._files)
+			files[n] = f
+
+	def scan(self, path: str, *pt, accept=None):
+		if accept is None:
+			parent = '/'.join(pt)
+			accept = lambda name, is_dir: self.filterc(parent, name, is_dir)
+		files: dict = {}
+		# the base itself isn't watched, its entries (the backup needs, which may be plain files) are always listed
+		if self.dirty is not None and len(pt) > 0 and not self.dirty.is_dirty(pt):
+			if self.dirty.skipped(pt):
+				return files
+			# the entries of this directory didn't change, only go down to the ones that did
+			for n in self.dirty.children(pt):
+				p = os.path.join(path, n)
+				if os.path.isdir(p) and accept(n, True):
+					files[n] = BackupDir.create(p, *pt, n, ctx=self)
+			return files
+		with os.scandir(path) as it:
+			for e in it:
+				is_dir = e.is_dir()
+				if not accept(e.name, is_dir):
+					continue
+				if is_dir:
+					files[e.name] = BackupDir.create(e.path, *pt, e.name, ctx=self, entry=e)
+				else:
+					files[e.name] = self.submit(BackupFile.create, e.path, *pt, e.name, ctx=self, entry=e)
+		if self.prev is not None:
+			for n in self.prev.get_total_files(*pt):
+				if n not in files:
+					f = self.prev.get(*pt, n)
+					if accept(n, isinstance(f, BackupDir)):
+						files[n] = f.__class__(type_=ModifiedType.REMOVE, name=n, mode=0)
+		return files
+
+	@staticmethod
+	def settle(files: dict, prev: Backup, *pt):
+		settled: dict = {}
+		for n, f in files.items():
+			f = resolve(f)
+			if isinstance(f, BackupDir):
+				f = f.settle(prev, *pt, n)
+			if f is not None:
+				settled[n] = f
+		return settled
+
 class BackupFile:
-	def __init__(self, type_: ModifiedType, name: str, mode: int, data: bytes = None, path: str = None, offset: int = -1, safety: bool = False, hash_: bytes = None):
+	__slots__ = ('_type', '_name', '_mode', '_data', '_path', '_offset', '_safety_data', '_hash', '_size', '_chunks', '_store', '_algo')
+
+	def __init__(self, type_: ModifiedType, name: str, mode: int, data: bytes = None, path: str = None, offset: int = -1, safety: bool = False, hash_: bytes = None,
+		size: int = -1, chunks: KeyList = None, store: ObjectStore = None, algo: int = HASH_SHA256):
 		self._type = type_
 		self._name = name
 		self._mode = mode
@@ -45,6 +167,10 @@ class BackupFile:
 		self._offset = offset
 		self._safety_data = safety
 		self._hash = hash_
+		self._size = size
+		self._chunks = chunks if chunks is None or isinstance(chunks, KeyList) else KeyList(chunks)
+		self._store = store
+		self._algo = algo
 
 	@property
 	def type(self):
@@ -58,25 +184,40 @@ class BackupFile:
 	def mode(self):
 		return self._mode
 
+	@property
+	def algo(self):
+		return self._algo
+
 	@property
 	def hash(self):
 		if self._mode == ModifiedType.REMOVE:
 			return None
 		if self._hash is None:
 			with self.data_file as rd:
-				self._hash = calchash(rd)
+				self._hash = file_hash(rd, self._algo, splitter_for(self._name))
 		return self._hash
 
 	@property
 	def safety_data(self):
 		return self._safety_data
 
+	@property
+	def size(self):
+		return self._size
+
+	@property
+	def chunks(self):
+		return self._chunks
+
 	@property
 	def data(self):
 		if self._type == ModifiedType.REMOVE:
 			return None
 		if self._data is not None:
 			return self._data
+		if self._chunks is not None:
+			with self.data_file as rd:
+				return rd.read()
 		if self._path is not None:
 			try:
 				with open(self._path, 'rb', 8192) as fd:
@@ -93,6 +234,8 @@ class BackupFile:
 			return None
 		if self._data is not None:
 			return io.BytesIO(self._data)
+		if self._chunks is not None:
+			return io.BufferedReader(ChunkReader(self._store, self._chunks), 8192)
 		if self._path is not None:
 			try:
 				fd = open(self._path, 'rb', 8192)
@@ -107,64 +250,167 @@ class BackupFile:
 		return None
 
 	@classmethod
-	def create(cls, path: str, *pt, filterc=lambda *a, **b: True, prev: Backup = None):
+	def create(cls, path: str, *pt, ctx: ScanContext, entry: os.DirEntry = None):
 		type_: ModifiedType
 		name: str = pt[-1]
 		mode: int
 		hash_: bytes = None
-		if os.path.exists(path):
+		try:
+			st = os.stat(path) if entry is None else entry.stat()
+		except FileNotFoundError:
+			st = None
+		if st is not None:
 			type_ = ModifiedType.UPDATE
-			mode = os.stat(path).st_mode & 0o777
-			if prev is not None:
-				pref = prev.get(*pt)
-				if isinstance(pref, cls) and mode == pref.mode:
-					try:
-						hash_ = calchash(open(path, 'rb', 8192))
-						if hash_ == pref.hash:
-							return None
-					except FileNotFoundError:
-						raise
-					except Exception as err:
-						raise RuntimeError(f'Error when read {path}', err)
+			mode = st.st_mode & 0o777
+			pref = None if ctx.prev is None else ctx.prev.get(*pt)
+			if not isinstance(pref, cls) or mode != pref.mode:
+				pref = None
+			if ctx.ref is not None:
+				# a file that kept its content since the reference backup can reuse its chunks
+				pref = ctx.ref.get(*pt)
+				if not isinstance(pref, cls) or pref.chunks is None:
+					pref = None
+			if pref is not None and pref.algo != ctx.algo: # hashes of another algorithm can't be compared
+				pref = None
+			if ctx.statc is not None:
+				hash_ = ctx.statc.get('/'.join(pt), st, ctx.algo)
+			if pref is not None and hash_ == pref.hash:
+				return cls._unchanged(name, mode, pref, ctx)
+			if ctx.staging is not None:
+				path = ctx.stage(path, *pt)
+			if hash_ is None and (pref is not None or ctx.statc is not None):
+				if ctx.staging is not None:
+					# read the staged copy after the world can be saved again
+					return functools.partial(cls._check, path, *pt, ctx=ctx, st=st, pref=pref)
+				return cls._check(path, *pt, ctx=ctx, st=st, pref=pref)
 		else:
+			if ctx.prev is None or not isinstance(ctx.prev.get(*pt), cls):
+				return None
 			type_ = ModifiedType.REMOVE
 			mode = 0
-		return cls(type_=type_, name=name, mode=mode, path=path, offset=0, hash_=hash_)
+		return cls(type_=type_, name=name, mode=mode, path=path, offset=0, hash_=hash_, algo=ctx.algo)
+
+	@classmethod
+	def _check(cls, path: str, *pt, ctx: ScanContext, st: os.stat_result, pref: BackupFile):
+		name: str = pt[-1]
+		mode: int = st.st_mode & 0o777
+		# hash and store in the same pass, chunks of an unchanged file are already in the store
+		try:
+			with open(path, 'rb', 0) as fd:
+				hash_, size, chunks = ctx.store.put_stream(fd, splitter_for(name), ctx.algo)
+		except FileNotFoundError:
+			raise
+		except Exception as err:
+			raise RuntimeError(f'Error when read {path}', err)
+		if ctx.statc is not None:
+			ctx.statc.put('/'.join(pt), st, hash_, ctx.algo)
+		if pref is not None and hash_ == pref.hash:
+			return cls._unchanged(name, mode, pref, ctx)
+		return cls(type_=ModifiedType.UPDATE, name=name, mode=mode, hash_=hash_, size=size, chunks=chunks, store=ctx.store, algo=ctx.algo)
+
+	@classmethod
+	def _unchanged(cls, name: str, mode: int, pref: BackupFile, ctx: ScanContext):
+		if ctx.ref is not None:
+			return cls(type_=ModifiedType.UPDATE, name=name, mode=mode, hash_=pref.hash, size=pref.size, chunks=pref.chunks, store=pref._store,
+				algo=pref.algo)
+		return None
 
 	def restore(self, path: str):
 		try:
-			with open(path, 'wb', 8192) as wd, self.data_file as rd:
-				writetofile(rd, wd)
+			try:
+				fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+			except PermissionError: # a read-only file is in the way
+				os.remove(path)
+				fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+			try:
+				self.write_to(fd)
+				if self._mode != 0:
+					os.fchmod(fd, self._mode)
+			finally:
+				os.close(fd)
 		except Exception as err:
 			raise RuntimeError(f'Error when restore {path}', err)
 
-	def save(self, path: str):
-		path = os.path.join(path, self._name + '.F')
-		with open(path, 'wb', 8192) as fd:
-			fd.write(self._type.to_bytes(1, byteorder='big'))
-			if self._type != ModifiedType.REMOVE:
-				fd.write(self._mode.to_bytes(2, byteorder='big'))
-				fd.write(self.hash)
+	def write_to(self, fd: int):
+		if self._type == ModifiedType.REMOVE:
+			return
+		if self._data is not None:
+			v = memoryview(self._data)
+			while v:
+				v = v[os.write(fd, v):]
+		elif self._chunks is not None:
+			for c in self._chunks:
+				self._store.copy_to(c, fd)
+		elif self._path is not None:
+			with open(self._path, 'rb', 0) as rd:
+				copy_range(rd.fileno(), fd, offset=self._offset)
+
+	def save_data(self, store: ObjectStore):
+		if self._type != ModifiedType.REMOVE and self._chunks is None:
+			if self._data is None and self._path is not None and self._offset == 0:
+				with open(self._path, 'rb', 0) as rd:
+					self._hash, self._size, self._chunks = store.put_stream(rd, splitter_for(self._name), self._algo)
+			else:
 				with self.data_file as rd:
-					writetofile(rd, fd)
-		self._path, self._offset = path, 35
+					self._hash, self._size, self._chunks = store.put_stream(rd, splitter_for(self._name), self._algo)
+			self._store = store
+
+	def save(self, fd, *pt):
+		# write the manifest record, save_data must have been called
+		_write_path(fd, pt)
+		fd.write(b'F')
+		fd.write(self._type.to_bytes(1, byteorder='big'))
+		if self._type != ModifiedType.REMOVE:
+			fd.write(self._mode.to_bytes(2, byteorder='big'))
+			fd.write(self._hash)
+			fd.write(self._size.to_bytes(8, byteorder='big'))
+			fd.write(len(self._chunks).to_bytes(4, byteorder='big'))
+			fd.write(self._chunks.raw)
+		self._data, self._path, self._offset = None, None, -1
 
 	@classmethod
-	def load(cls, path: str, prev: BackupFile = None):
+	def read(cls, fd, name: str, store: ObjectStore, algo: int = HASH_SHA256):
+		type_ = ModifiedType(int.from_bytes(fd.read(1), byteorder='big'))
+		if type_ == ModifiedType.REMOVE:
+			return cls(type_=type_, name=name, mode=0, safety=True)
+		mode = int.from_bytes(fd.read(2), byteorder='big')
+		hash_ = fd.read(32)
+		size = int.from_bytes(fd.read(8), byteorder='big')
+		n = int.from_bytes(fd.read(4), byteorder='big')
+		b = fd.read(32 * n)
+		# the key of a file's only chunk is usually its hash, keep one copy of it
+		chunks = KeyList(hash_ if b == hash_ else b)
+		return cls(type_=type_, name=name, mode=mode, safety=True, hash_=hash_, size=size, chunks=chunks, store=store, algo=algo)
+
+	@classmethod
+	def load(cls, path: str, version: int = 2, store: ObjectStore = None):
 		type_: ModifiedType
 		name: str = os.path.splitext(os.path.basename(path))[0]
 		mode: int
 		hash_: bytes = None
-		with open(path, 'rb', 36) as fd:
+		size: int = -1
+		chunks: list = None
+		with open(path, 'rb', 8192) as fd:
 			type_ = ModifiedType(int.from_bytes(fd.read(1), byteorder='big'))
 			if type_ == ModifiedType.REMOVE:
 				mode = 0
 			else:
 				mode = int.from_bytes(fd.read(2), byteorder='big')
 				hash_ = fd.read(32)
+				if version >= 2:
+					size = int.from_bytes(fd.read(8), byteorder='big')
+					n = int.from_bytes(fd.read(4), byteorder='big')
+					chunks = [fd.read(32) for _ in range(n)]
+		if chunks is not None:
+			return cls(type_=type_, name=name, mode=mode, safety=True, hash_=hash_, size=size, chunks=chunks, store=store)
 		return cls(type_=type_, name=name, mode=mode, path=path, offset=35, safety=True, hash_=hash_)
 
+	def walk_files(self):
+		yield self
+
 class BackupDir:
+	__slots__ = ('_type', '_name', '_mode', '_files')
+
 	def __init__(self, type_: ModifiedType, name: str, mode: int, files: dict = None):
 		self._type = type_
 		self._name = name
@@ -186,7 +432,7 @@ class BackupDir:
 
 	@property
 	def files(self):
-		return self._files.copy()
+		return types.MappingProxyType(self._files)
 
 	def get(self, base, *path):
 		f = self._files.get(base, None)
@@ -195,45 +441,56 @@ class BackupDir:
 		return f
 
 	@classmethod
-	def create(cls, path: str, *pt, filterc=lambda *a, **b: True, prev: Backup = None):
+	def create(cls, path: str, *pt, ctx: ScanContext, entry: os.DirEntry = None):
+		# Children may still be pending in the worker pool, call settle when the pool is drained
 		type_: ModifiedType
 		name: str = pt[-1]
 		mode: int
-		files: set = set()
-		if os.path.isdir(path):
-			mode = os.stat(path).st_mode & 0o777
-			l = set(os.listdir(path))
-			if prev is not None:
-				l.update(prev.get_total_files(*pt))
-			for n in filter(lambda a: filterc(os.path.join(*pt), a), l):
-				f = os.path.join(path, n)
-				files.add((BackupDir if os.path.isdir(f) else BackupFile if os.path.exists(f) else prev.get(*pt, n).__class__).\
-					create(f, *pt, n, filterc=filterc, prev=prev))
-			if prev is not None and len(files) == 0 and pt[-1] in prev.get_total_files(*pt[:-1]):
-				return None
+		files: dict = {}
+		try:
+			st = os.stat(path) if entry is None else entry.stat()
+			files = ctx.scan(path, *pt)
+		except FileNotFoundError:
+			st = None
+		if st is not None:
 			type_ = ModifiedType.UPDATE
+			mode = st.st_mode & 0o777
 		else:
 			type_ = ModifiedType.REMOVE
 			mode = 0
-		if None in files:
-			files.remove(None)
-		return cls(type_=type_, name=name, mode=mode, files=list(files))
+		return cls(type_=type_, name=name, mode=mode, files=files)
 
-	def save(self, path: str):
-		path = os.path.join(path, self._name + '.D')
-		if self._type == ModifiedType.REMOVE:
-			with open(path, 'wb', 1) as fd:
-				fd.write(self._type.to_bytes(1, byteorder='big'))
-		else:
-			os.mkdir(path)
-			with open(os.path.join(path, '0'), 'wb', 3) as fd:
-				fd.write(self._type.to_bytes(1, byteorder='big'))
-				fd.write(self._mode.to_bytes(2, byteorder='big'))
-			for f in self._files.values():
-				f.save(path)
+	def settle(self, prev: Backup, *pt):
+		files = self._files = ScanContext.settle(self._files, prev, *pt)
+		if prev is not None and len(files) == 0 and self._type == ModifiedType.UPDATE:
+			pf = prev.get(*pt)
+			if isinstance(pf, BackupDir) and pf.type != ModifiedType.REMOVE:
+				return None
+		return self
+
+	def save(self, fd, *pt):
+		_write_path(fd, pt)
+		fd.write(b'D')
+		fd.write(self._type.to_bytes(1, byteorder='big'))
+		if self._type != ModifiedType.REMOVE:
+			fd.write(self._mode.to_bytes(2, byteorder='big'))
+			for n in sorted(self._files.keys()):
+				self._files[n].save(fd, *pt, n)
 
 	@classmethod
-	def load(cls, path: str):
+	def read(cls, fd, name: str, store: ObjectStore, algo: int = HASH_SHA256):
+		type_ = ModifiedType(int.from_bytes(fd.read(1), byteorder='big'))
+		mode: int = 0
+		if type_ != ModifiedType.REMOVE:
+			mode = int.from_bytes(fd.read(2), byteorder='big')
+		return cls(type_=type_, name=name, mode=mode)
+
+	def walk_files(self):
+		for f in self._files.values():
+			yield from f.walk_files()
+
+	@classmethod
+	def load(cls, path: str, version: int = 2, store: ObjectStore = None):
 		type_: ModifiedType
 		name: str = os.path.splitext(os.path.basename(path))[0]
 		mode: int
@@ -248,9 +505,9 @@ class BackupDir:
 					f = os.path.join(path, n)
 					e = os.path.splitext(f)[1]
 					if e == '.F':
-						files.append(BackupFile.load(f))
+						files.append(BackupFile.load(f, version, store))
 					elif e == '.D':
-						files.append(BackupDir.load(f))
+						files.append(BackupDir.load(f, version, store))
 		else:
 			with open(path, 'rb', 1) as fd:
 				type_ = ModifiedType(int.from_bytes(fd.read(1), byteorder='big'))
@@ -258,9 +515,80 @@ class BackupDir:
 				mode = 0
 		return cls(type_=type_, name=name, mode=mode, files=files)
 
+class Manifest:
+	# The flattened effective state of a backup: path tuple -> entry, plus the names under every directory.
+	# REMOVE entries are applied instead of being stored.
+	def __init__(self, entries: dict = None, children: dict = None):
+		self._entries = {} if entries is None else entries
+		self._children = {(): set()} if children is None else children
+		self._owned = set()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, pt: tuple):
+		return self._entries.get(pt, None)
+
+	def children(self, pt: tuple = ()):
+		# the returned set is shared, don't change it
+		return self._children.get(pt, frozenset())
+
+	def iter(self, pt: tuple = ()):
+		# sorted by path, parents always come before their children
+		for n in sorted(self.children(pt)):
+			c = (*pt, n)
+			f = self._entries[c]
+			yield c, f
+			if isinstance(f, BackupDir):
+				yield from self.iter(c)
+
+	@classmethod
+	def merge(cls, base: Manifest, files: dict):
+		m = cls(base._entries.copy(), base._children.copy())
+		for n, f in files.items():
+			m._apply((n,), f)
+		m._owned.clear()
+		return m
+
+	def _child_set(self, pt: tuple):
+		# the sets are shared with the base manifest until they are changed
+		if pt not in self._owned:
+			self._children[pt] = set(self._children.get(pt, ()))
+			self._owned.add(pt)
+		return self._children[pt]
+
+	def _drop(self, pt: tuple):
+		self._entries.pop(pt, None)
+		for n in self._children.pop(pt, ()):
+			self._drop(pt + (n,))
+		self._owned.discard(pt)
+
+	def _apply(self, pt: tuple, f):
+		if f.type == ModifiedType.REMOVE:
+			if pt in self._entries:
+				self._drop(pt)
+				self._child_set(pt[:-1]).discard(pt[-1])
+			return
+		old = self._entries.get(pt, None)
+		if old is not None and isinstance(old, BackupDir) != isinstance(f, BackupDir):
+			self._drop(pt)
+		self._entries[pt] = f
+		self._child_set(pt[:-1]).add(pt[-1])
+		if isinstance(f, BackupDir):
+			if pt not in self._children:
+				self._children[pt] = set()
+				self._owned.add(pt)
+			for n, c in f._files.items():
+				self._apply(pt + (n,), c)
+
 class Backup:
+	HEADER_COST = 1024
+	ENTRY_COST = 400
+	MANIFEST_COST = 100
+
 	def __init__(self, mode: BackupMode, timestamp: int, comment: str, outdate: int, files: dict = None,
-		*, safety: bool = False, manager: BackupManager = None, prev: [Backup, str] = None):
+		*, safety: bool = False, manager: BackupManager = None, prev: [Backup, str] = None, loader=None, algo: int = HASH_SHA256):
+		# when loader is given the file tree is only read the first time it's needed
 		self._manager = manager if manager is not None else None if prev is None else prev.manager
 		assert self._manager is not None
 		self._mode = mode
@@ -270,11 +598,24 @@ class Backup:
 		self._files = dict((f.name, f) for f in files) if isinstance(files, (list, tuple, set)) else files.copy() if isinstance(files, dict) else {}
 		self._safety = safety
 		self._prev = prev
+		self._pending = None
+		self._manifest = None
+		self._loader = loader
+		self._lock = threading.RLock()
+		self._written = None
+		self._cost = None
+		self._algo = algo
+		self._held = False # created with the collector held off until it's saved
 
 	@property
 	def manager(self):
 		return self._manager
 
+	@property
+	def algo(self):
+		# the hash algorithm of the files recorded by this backup
+		return self._algo
+
 	@property
 	def mode(self):
 		return self._mode
@@ -303,6 +644,18 @@ class Backup:
 	def is_safety(self):
 		return self._safety
 
+	@property
+	def size(self):
+		# bytes of the files recorded in this backup
+		s = self._manager.index.size_of(self.id)
+		return 0 if s is None else s[0]
+
+	@property
+	def disk_size(self):
+		# bytes only this backup holds on disk
+		s = self._manager.index.size_of(self.id)
+		return 0 if s is None else s[1]
+
 	@property
 	def prev(self):
 		if self._mode == BackupMode.FULL:
@@ -316,6 +669,9 @@ class Backup:
 
 	@property
 	def z_index(self):
+		index = self._manager.index
+		if self.id in index:
+			return index.depth(self.id)
 		z: int = 0
 		prev = self.prev
 		while prev is not None:
@@ -325,104 +681,207 @@ class Backup:
 
 	@property
 	def files(self):
-		return self._files.copy()
+		return types.MappingProxyType(self._tree())
+
+	def _tree(self):
+		if self._loader is not None:
+			with self._lock:
+				if self._loader is not None:
+					self._files = dict((f.name, f) for f in self._loader())
+					self._loader = None
+		return self._files
+
+	@property
+	def footprint(self):
+		# a rough estimate of the memory held by this backup, for sizing the cache
+		if self._loader is not None:
+			return Backup.HEADER_COST
+		if self._cost is None:
+			entries, chunks = 0, 0
+			que = list(self._files.values())
+			while len(que) > 0:
+				f = que.pop()
+				entries += 1
+				if isinstance(f, BackupDir):
+					que.extend(f._files.values())
+				elif f.chunks is not None:
+					chunks += len(f.chunks)
+			self._cost = Backup.HEADER_COST + entries * Backup.ENTRY_COST + chunks * 40
+		return self._cost + (0 if self._manifest is None else len(self._manifest) * Backup.MANIFEST_COST)
 
 	def has_parent(self, pid):
+		index = self._manager.index
+		if self.id in index:
+			return index.has_parent(self.id, pid)
 		if self.prev is None:
 			return False
 		if self.prev.id == pid:
 			return True
 		return self.prev.has_parent(pid)
 
+	@property
+	def manifest(self):
+		if self._manifest is None:
+			with self._lock:
+				if self._manifest is None:
+					prev = self.prev
+					self._manifest = Manifest.merge(Manifest() if prev is None else prev.manifest, self._tree())
+		return self._manifest
+
 	def get_total_files(self, *path):
-		files = self
-		for f in path:
-			files = files.files.get(f)
-			if files is None:
-				filel = set()
-				break
-		else:
-			filel = set(files.files.keys())
-		if self._mode != BackupMode.FULL:
-			filel.update(self.prev.get_total_files(*path))
-		return set(filter(lambda a: self.get(*path, a).type != ModifiedType.REMOVE, filel))
+		return self.manifest.children(path)
 
 	def get(self, base, *path):
-		f = self._files.get(base, None)
-		if f is not None and len(path) > 0:
-			f = f.get(*path)
-		if f is None and self.prev is not None:
-			return self.prev.get(base, *path)
-		return f
-
-	def restore(self, path: str, needs: list, ignores: list = []):
-		if not self._safety:
-			pth = os.path.join(self._basepath, hex(self._timestamp))
-			if not os.path.exists(pth):
-				self.save()
-			self = self.__class__.load(self._basepath, cached=False)
-		files = []
-		que = queue.SimpleQueue()
-		for f in self.get_total_files():
-			que.put([f])
-		while not que.empty():
-			n = que.get_nowait()
-			f = self.get(*n)
-			files.append([os.path.join(path, *n), f])
-			if isinstance(f, BackupDir):
-				for m in self.get_total_files(*n):
-					que.put([*n, m])
+		return self.manifest.get((base, *path))
+
+	@_holding
+	def restore(self, path: str, needs: list, ignores: list = [], *, differential: bool = False):
+		# With differential, the live files are compared with the backup first, only the files that
+		# differ are rewritten and only the files that aren't in the backup are removed.
+		if not self._safety and not os.path.exists(os.path.join(self._manager.basepath, self.id)):
+			self.save()
+		manifest = self.manifest
+		statc = self._manager.statcache if differential else None
 		filterc = filters(ignores)
 		for n in needs:
-			clear_dir(os.path.join(path, n), filterc)
-		for p, f in files:
-			if isinstance(f, BackupDir) and not os.path.exists(p):
-				os.makedirs(p)
-			elif isinstance(f, BackupFile):
-				f.restore(p)
+			if differential:
+				prune_dir(os.path.join(path, n), manifest, filterc, n)
+			else:
+				clear_dir(os.path.join(path, n), filterc, n)
+		# directories are created in order while the files are written by the pool,
+		# their modes are applied last so a read-only directory can still be filled
+		dirs: list = []
+		errors: list = []
+		def done(fut):
+			if fut.exception() is not None:
+				errors.append(fut.exception())
+		with self._manager.new_pool() as pool:
+			for pt, f in manifest.iter():
+				if len(errors) > 0:
+					break
+				p = os.path.join(path, *pt)
+				if isinstance(f, BackupDir):
+					os.makedirs(p, exist_ok=True)
+					dirs.append((p, f.mode))
+				elif isinstance(f, BackupFile):
+					pool.submit(restore_file, p, f, statc, '/'.join(pt), differential=differential,
+						throttle=self._manager.throttle).add_done_callback(done)
+		if len(errors) > 0:
+			raise errors[0]
+		for p, mode in reversed(dirs):
+			if mode != 0:
+				os.chmod(p, mode)
+
+	def _settle(self, ctx: ScanContext):
+		with self._manager.new_pool() as pool:
+			ctx.pool = pool
+			ctx.run_deferred(self._files)
+		ctx.pool = None
+		self._files = ScanContext.settle(self._files, self.prev)
+		self._manifest = None
+		if ctx.statc is not None and ctx.dirty is None:
+			ctx.statc.prune()
 
 	def save(self):
+		try:
+			if self._pending is not None:
+				ctx, self._pending = self._pending, None
+				try:
+					self._settle(ctx)
+					self._save()
+				finally:
+					shutil.rmtree(ctx.staging, ignore_errors=True)
+			else:
+				self._save()
+		finally:
+			if self._held:
+				self._held = False
+				self._manager._unhold()
+
+	def _save(self):
 		if not os.path.exists(self._manager.basepath):
 			os.makedirs(self._manager.basepath)
 		path = os.path.join(self._manager.basepath, hex(self._timestamp))
 		os.mkdir(path)
 		try:
-			with open(os.path.join(path, '0'), 'wb', 8192) as fd:
-				comment = self._comment.encode('utf8')
-				fd.write(self._mode.to_bytes(1, byteorder='big'))
-				fd.write(int(0 if self.prev is None else self.prev.timestamp * 1000).to_bytes(8, byteorder='big'))
-				fd.write(int(self._outdate).to_bytes(8, byteorder='big'))
-				fd.write(len(comment).to_bytes(2, byteorder='big'))
-				fd.write(comment)
-			for f in self._files.values():
-				f.save(path)
+			self._save_header(os.path.join(path, '0'))
+			store = self._manager.store
+			with self._manager.new_pool() as pool:
+				for fut in [pool.submit(f.save_data, store) for f in self.walk_files()]:
+					fut.result()
+			store.flush()
+			self._save_manifest(os.path.join(path, 'manifest'))
+			# the index must not point at a backup that may not survive a crash
+			fsync_dir(path)
+			fsync_dir(self._manager.basepath)
+			logical = sum(f.size for f in self.walk_files() if f.type != ModifiedType.REMOVE)
+			unique = _dir_size(path) + (0 if self._written is None else store.written - self._written)
 		except:
 			shutil.rmtree(path)
 			raise
 		else:
-			self._manager.index.append(self)
+			index = self._manager.index
+			index.append(self)
+			index.set_size(self.id, logical, unique)
+			index.total += unique
+			index.commit()
+			self._manager.cache.put(self)
+			self._manager.statcache.save(self._manager.basepath)
+			self._manager._saved(self)
+
+	def _save_header(self, path: str):
+		with open(path, 'wb', 8192) as fd:
+			comment = self._comment.encode('utf8')
+			fd.write(self._mode.to_bytes(1, byteorder='big'))
+			fd.write(int(0 if self.prev is None else self.prev.timestamp * 1000).to_bytes(8, byteorder='big'))
+			fd.write(int(self._outdate).to_bytes(8, byteorder='big'))
+			fd.write(len(comment).to_bytes(2, byteorder='big'))
+			fd.write(comment)
+			fd.write(FORMAT_VERSION.to_bytes(1, byteorder='big'))
+			fd.write(self._algo.to_bytes(1, byteorder='big'))
+			fd.flush()
+			os.fsync(fd.fileno())
+
+	def _save_manifest(self, path: str):
+		tree = self._tree()
+		with open(path, 'wb', 1024 * 64) as fd:
+			for n in sorted(tree.keys()):
+				tree[n].save(fd, n)
+			fd.flush()
+			os.fsync(fd.fileno())
+
+	def walk_files(self):
+		for f in self._tree().values():
+			yield from f.walk_files()
 
 	def remove(self):
-		pred: list = self._manager.index.remove(self)
-		for d in pred:
-			shutil.rmtree(os.path.join(self._manager.basepath, d))
+		return self._manager.remove(self)
 
 	def __hash__(self):
 		return hash(hex(self.timestamp))
 
 class BackupIndex:
-	def __init__(self, *,
-		last: str = None,
-		ls: list = [],
-		nodes: list = [],
-		fulln: list = [],
-		outdates: list = []):
-
-		self._last = last
-		self._list = ls
-		self._nodes = nodes
-		self._fulln = fulln
-		self._outdates = outdates
+	# The state is kept in index.json, every change after it is appended to index.journal as one json line.
+	# commit makes the appended changes durable, compact folds the journal back into index.json.
+	COMPACT_LINES = 256
+
+	def __init__(self):
+		# guards the state and the journal, the collector writes sizes while the job thread pops outdated backups
+		self._lock = getattr(self, '_lock', None) or threading.RLock() # load resets the state, not the lock
+		self._path = None
+		self._last = None
+		self._backups = {} # id -> [prev id, mode, outdate], in creation order
+		# the backup graph: depth is the distance to the full backup a backup is based on (its root)
+		self._children = {}
+		self._depth = {}
+		self._root = {}
+		self._nodes = {} # ordered sets of ids
+		self._fulln = {}
+		self._outdates = []
+		self._sizes = {} # id -> [logical size, unique size]
+		self._total = 0
+		self._journal = None
+		self._lines = 0
 
 	@property
 	def last(self):
@@ -430,110 +889,398 @@ class BackupIndex:
 
 	@property
 	def list(self):
-		return self._list
+		return list(self._backups.keys())
 
 	@property
 	def nodes(self):
-		return self._nodes
+		return list(self._nodes.keys())
 
 	@property
 	def fulln(self):
-		return self._fulln
+		return list(self._fulln.keys())
 
 	@property
 	def outdates(self):
 		return self._outdates
 
+	@property
+	def total(self):
+		return self._total
+
+	@total.setter
+	def total(self, total: int):
+		self._log({'t': total})
+
+	def __contains__(self, bid: str):
+		return bid in self._backups
+
+	def __len__(self):
+		return len(self._backups)
+
+	def depth(self, bid: str):
+		return self._depth.get(bid, 0)
+
+	def root(self, bid: str):
+		return self._root.get(bid, None)
+
+	def dependents(self, bid: str):
+		# every backup that needs bid to be restored, parents before children
+		deps: list = []
+		que = list(self._children.get(bid, ()))
+		while len(que) > 0:
+			i = que.pop(0)
+			deps.append(i)
+			que.extend(self._children.get(i, ()))
+		return deps
+
+	def has_parent(self, bid: str, pid: str):
+		if bid not in self._backups or self._root.get(bid) != self._root.get(pid):
+			return False
+		d = self._depth[bid] - self._depth.get(pid, 0)
+		if d <= 0:
+			return False
+		p = bid
+		for _ in range(d):
+			p = self._backups[p][0]
+		return p == pid
+
+	def size_of(self, bid: str):
+		return self._sizes.get(bid, None)
+
+	def set_size(self, bid: str, logical: int, unique: int):
+		self._log({'s': [bid, logical, unique]})
+
+	def missing_sizes(self):
+		return any(i not in self._sizes for i in self._backups)
+
 	def pop_outdated(self):
-		if len(self._outdates) == 0:
+		with self._lock:
+			if len(self._outdates) == 0:
+				return None
+			b = self._outdates[0]
+			if b[1] <= time.time() // 60:
+				self._log({'o': b[0]})
+				return b[0]
 			return None
-		b = self._outdates[0]
-		if b[1] <= time.time() // 60:
-			self._outdates.pop(0)
-			return b[0]
-		return None
 
-	def load(self, path: str):
-		idx = os.path.join(path, 'index.json')
-		index: dict = {}
-		if os.path.exists(idx):
-			with open(idx, 'r') as fd:
-				index = json.load(fd)
-		self._last = index.get('last', None)
-		self._list = index.get('list', [])
-		self._nodes = index.get('nodes', [])
-		self._fulln = index.get('fulln', [])
-		self._outdates = index.get('outdates', [])
+	def append(self, bk: Backup):
+		self._log({'a': [bk.id, None if bk.prev is None else bk.prev.id, int(bk.mode), bk.outdate]})
 
-	def save(self, path: str):
-		with open(os.path.join(path, 'index.json'), 'w') as fd:
-			json.dump({
-				'last': self._last,
-				'list': self._list,
-				'nodes': self._nodes,
-				'fulln': self._fulln,
-				'outdates': self._outdates
-			}, fd, separators=(',', ':'))
+	def promote(self, bk: Backup):
+		# bk was rewritten into a full backup, so it starts a chain of its own
+		self._log({'p': bk.id})
 
-	def append(self, bk: Backup):
-		bid: str = bk.id
-		if bk.prev is None or self._last != bk.prev.id:
-			self._nodes.append(bid)
-			if bk.prev is None: # mode == BackupMode.FULL
-				self._fulln.append(bid)
-				if bk.outdate != 1:
-					self._outdates = BackupIndex.insertOutdate(self._outdates, bk)
-		self._last = bid
-		self._list.append(bid)
+	def remove(self, bk: Backup):
+		# bk and every backup depending on it
+		lst = [bk.id, *self.dependents(bk.id)]
+		self._log({'r': lst})
+		return lst
+
+	def _apply(self, rec: dict):
+		if 'a' in rec:
+			bid, prev, mode, outdate = rec['a']
+			if bid in self._backups: # replayed over a compacted index
+				return
+			if prev is None or self._last != prev:
+				self._nodes[bid] = None
+				if prev is None: # mode == BackupMode.FULL
+					self._fulln[bid] = None
+					if outdate != 1:
+						self._outdates = BackupIndex.insertOutdate(self._outdates, bid, outdate)
+			self._last = bid
+			self._backups[bid] = [prev, mode, outdate]
+			self._link(bid, prev)
+		elif 's' in rec:
+			bid, logical, unique = rec['s']
+			self._sizes[bid] = [logical, unique]
+		elif 't' in rec:
+			self._total = rec['t']
+		elif 'o' in rec:
+			self._outdates = [o for o in self._outdates if o[0] != rec['o']]
+		elif 'p' in rec:
+			bid = rec['p']
+			b = self._backups[bid]
+			if b[0] in self._children:
+				self._children[b[0]].pop(bid, None)
+			b[0], b[1] = None, int(BackupMode.FULL)
+			self._depth[bid], self._root[bid] = 0, bid
+			for i in self.dependents(bid):
+				p = self._backups[i][0]
+				self._depth[i], self._root[i] = self._depth[p] + 1, bid
+			self._nodes = self._resort(self._nodes, bid)
+			self._fulln = self._resort(self._fulln, bid)
+			if b[2] != 1 and all(o[0] != bid for o in self._outdates):
+				self._outdates = BackupIndex.insertOutdate(self._outdates, bid, b[2])
+		elif 'r' in rec:
+			for i in rec['r']:
+				b = self._backups.pop(i, None)
+				if b is not None and b[0] in self._children:
+					self._children[b[0]].pop(i, None)
+				self._children.pop(i, None)
+				self._depth.pop(i, None)
+				self._root.pop(i, None)
+				self._nodes.pop(i, None)
+				self._fulln.pop(i, None)
+				self._sizes.pop(i, None)
+			removed = set(rec['r'])
+			self._outdates = [o for o in self._outdates if o[0] not in removed]
+			if self._last in removed:
+				self._last = next(reversed(self._backups.keys()), None)
+
+	def _link(self, bid: str, prev: str):
+		# parents are always added before their children
+		self._children[bid] = {}
+		if prev is None or prev not in self._children:
+			self._depth[bid], self._root[bid] = 0, bid
+		else:
+			self._children[prev][bid] = None
+			self._depth[bid], self._root[bid] = self._depth[prev] + 1, self._root[prev]
+
+	def _resort(self, ids: dict, bid: str):
+		ids[bid] = None
+		return dict((i, None) for i in self._backups.keys() if i in ids)
+
+	def _log(self, rec: dict):
+		with self._lock:
+			self._apply(rec)
+			if self._path is None:
+				return
+			if self._journal is None:
+				self._journal = open(os.path.join(self._path, 'index.journal'), 'a')
+			self._journal.write(json.dumps(rec, separators=(',', ':')) + '\n')
+			self._lines += 1
+
+	def commit(self):
+		with self._lock:
+			if self._journal is not None:
+				self._journal.flush()
+				os.fsync(self._journal.fileno())
+			if self._lines >= BackupIndex.COMPACT_LINES:
+				self.compact()
+
+	def close(self):
+		with self._lock:
+			self.commit()
+			if self._journal is not None:
+				self._journal.close()
+				self._journal = None
 
 	@staticmethod
-	def insertOutdate(outdates: list, bk: Backup):
-		manager = bk.manager
+	def insertOutdate(outdates: list, bid: str, outdate: int):
 		i: int
 		for i, b in enumerate(outdates):
-			if b[1] > bk.outdate:
+			if b[1] > outdate:
 				break
 		else:
-			outdates.append([bk.id, bk.outdate])
+			outdates.append([bid, outdate])
 			return outdates
-		outdates.insert(i, [bk.id, bk.outdate])
-		print('OUTDATES:', outdates)
+		outdates.insert(i, [bid, outdate])
 		return outdates
 
-	def remove(self, bk: Backup):
-		pr: Backup = bk
-		i: int
-		while True:
-			try:
-				i = self._nodes.index(pr.id)
-			except ValueError as e:
-				pr = pr.prev
+	def load(self, path: str):
+		with self._lock:
+			self.__init__()
+			idx = os.path.join(path, 'index.json')
+			index: dict = {}
+			if os.path.exists(idx):
+				with open(idx, 'r') as fd:
+					index = json.load(fd)
+			self._last = index.get('last', None)
+			if 'backups' in index:
+				self._backups = dict((b[0], b[1:]) for b in index['backups'])
+				for bid, b in self._backups.items():
+					self._link(bid, b[0])
 			else:
-				break
-		s = self._list.index(bk.id)
-		while True:
-			i += 1
-			if i >= len(self._nodes):
-				e = len(self._list)
-				break
-			nid = self._nodes[i]
-			if not bk.manager.load(nid).has_parent(bk.id):
-				e = self._list.index(nid)
-				break
-		if e == len(self._list):
-			self._last = self._list[s - 1] if s > 0 else None
-		lst = self._list[s:e]
-		del self._list[s:e]
-		self._nodes = [i for i in self._nodes if i not in lst]
-		self._fulln = [i for i in self._fulln if i not in lst]
-		self._outdates = [i for i in self._outdates if i not in lst]
-		return lst
+				# written by an older version, the parents come from the backup headers
+				for bid in index.get('list', []):
+					if os.path.exists(os.path.join(path, bid, '0')):
+						mode, previd, outdate, _, _, _ = _read_header(os.path.join(path, bid))
+						self._backups[bid] = [None if previd == 0 else hex(previd), int(mode), outdate]
+						self._link(bid, self._backups[bid][0])
+			self._nodes = dict((i, None) for i in index.get('nodes', []) if i in self._backups)
+			self._fulln = dict((i, None) for i in index.get('fulln', []) if i in self._backups)
+			self._outdates = [o for o in index.get('outdates', []) if o[0] in self._backups]
+			self._sizes = index.get('sizes', {})
+			self._total = index.get('total', 0)
+			jf = os.path.join(path, 'index.journal')
+			if os.path.exists(jf):
+				with open(jf, 'r') as fd:
+					for line in fd:
+						try:
+							rec = json.loads(line)
+						except ValueError: # the tail of an interrupted write
+							break
+						self._apply(rec)
+						self._lines += 1
+			self._path = path
+
+	def compact(self):
+		self.save(self._path)
+
+	def save(self, path: str):
+		with self._lock:
+			tmp = os.path.join(path, 'index.json.tmp')
+			with open(tmp, 'w') as fd:
+				json.dump({
+					'version': 2,
+					'last': self._last,
+					'backups': [[i, *b] for i, b in self._backups.items()],
+					'nodes': self.nodes,
+					'fulln': self.fulln,
+					'outdates': self._outdates,
+					'sizes': self._sizes,
+					'total': self._total
+				}, fd, separators=(',', ':'))
+				fd.flush()
+				os.fsync(fd.fileno())
+			os.replace(tmp, os.path.join(path, 'index.json'))
+			if self._journal is not None:
+				self._journal.close()
+				self._journal = None
+			jf = os.path.join(path, 'index.journal')
+			if os.path.exists(jf):
+				os.remove(jf)
+			self._lines = 0
+			self._path = path
+
+class StatCache:
+	# entries modified this close (in seconds) to the moment they are hashed may still
+	# change without touching mtime, so they are not trusted by the next backup
+	RACY_WINDOW = 2
+
+	def __init__(self):
+		self._entries = {}
+		self._seen = set()
+
+	def get(self, key: str, st: os.stat_result, algo: int = HASH_SHA256):
+		self._seen.add(key)
+		e = self._entries.get(key, None)
+		if e is None or e[0] != st.st_size or e[1] != st.st_mtime_ns or e[2] != st.st_ino:
+			return None
+		if (e[4] if len(e) > 4 else HASH_SHA256) != algo:
+			return None
+		return bytes.fromhex(e[3])
+
+	def put(self, key: str, st: os.stat_result, hash_: bytes, algo: int = HASH_SHA256):
+		self._seen.add(key)
+		if st.st_mtime_ns >= (time.time() - StatCache.RACY_WINDOW) * 1e9:
+			self._entries.pop(key, None)
+			return
+		self._entries[key] = [st.st_size, st.st_mtime_ns, st.st_ino, hash_.hex(), algo]
+
+	def clear(self):
+		self._entries.clear()
+
+	def begin(self):
+		self._seen.clear()
+
+	def prune(self):
+		for k in [k for k in self._entries.keys() if k not in self._seen]:
+			self._entries.pop(k)
+		self._seen.clear()
+
+	def load(self, path: str):
+		cf = os.path.join(path, 'statcache.json')
+		self._entries = {}
+		if os.path.exists(cf):
+			with open(cf, 'r') as fd:
+				try:
+					self._entries = json.load(fd)
+				except ValueError:
+					pass
+
+	def save(self, path: str):
+		tmp = os.path.join(path, 'statcache.json.tmp')
+		with open(tmp, 'w') as fd:
+			json.dump(self._entries, fd, separators=(',', ':'))
+			fd.flush()
+			os.fsync(fd.fileno())
+		os.replace(tmp, os.path.join(path, 'statcache.json'))
+
+class BackupCache:
+	# The recently used backups, bounded by count and by their estimated memory.
+	# A backup that is still the prev of a cached one stays alive anyway, so the bound is approximate.
+	def __init__(self, size: int = 32, memory: int = 256 * 1024 * 1024):
+		self._size = size
+		self._memory = memory
+		self._items = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def configure(self, size: int = None, memory: int = None):
+		with self._lock:
+			if size is not None:
+				self._size = size
+			if memory is not None:
+				self._memory = memory
+			self._shrink()
+
+	def get(self, bid: str):
+		with self._lock:
+			bk = self._items.get(bid, None)
+			if bk is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self._items.move_to_end(bid)
+			return bk
+
+	def put(self, bk: Backup):
+		with self._lock:
+			self._items[bk.id] = bk
+			self._items.move_to_end(bk.id)
+			self._shrink()
+
+	def pop(self, bid: str):
+		with self._lock:
+			return self._items.pop(bid, None)
+
+	def clear(self):
+		with self._lock:
+			self._items.clear()
+
+	def __len__(self):
+		return len(self._items)
+
+	@property
+	def memory(self):
+		return sum(b.footprint for b in list(self._items.values()))
+
+	def _shrink(self):
+		while len(self._items) > max(self._size, 1):
+			self._items.popitem(last=False)
+		if self._memory > 0:
+			mem = sum(b.footprint for b in self._items.values())
+			while len(self._items) > 1 and mem > self._memory:
+				_, b = self._items.popitem(last=False)
+				mem -= b.footprint
 
 class BackupManager:
 	def __init__(self, basepath: str):
-		self.__cache = weakref.WeakValueDictionary()
+		self.__cache = BackupCache()
 		self.__basepath = basepath
 		self.__index = BackupIndex()
+		self.__statcache = StatCache()
+		self.__throttle = IOThrottle()
+		self.__store = ObjectStore(os.path.join(basepath, 'objects'), throttle=self.__throttle)
+		self.__workers = 0
+		self.__low_priority = False
+		self.__algo = HASH_SHA256
+		# the collector deletes removed backups and unreferenced objects in the background,
+		# it only works on the store while nothing holds it
+		self.__gc = threading.Condition()
+		self.__busy = 0
+		self.__holds = 0 # changes every time something holds the store, so the collector sees what it read went stale
+		self.__collecting = False
+		self.__collector = None
+		self.__collect = False
+		self.__closed = False
+		self.__gc_pause = 0.05
+		self.__on_error = None # called with what failed in the collector instead of printing it
+		self.__watcher = None
+		self.__watched = None # the backup the recorded changes are relative to
+		self.__pending = None
 
 		self._loadcfg()
 
@@ -545,82 +1292,486 @@ class BackupManager:
 	def index(self):
 		return self.__index
 
+	@property
+	def statcache(self):
+		return self.__statcache
+
+	@property
+	def store(self):
+		return self.__store
+
+	@property
+	def cache(self):
+		return self.__cache
+
+	def configure(self, *, workers: int = None, cache_size: int = None, cache_memory: int = None, compression: str = None,
+		hash_algorithm: str = None, gc_pause: float = None, io_running: tuple = None, io_stopped: tuple = None, low_priority: bool = None,
+		on_error=None):
+		# io_running and io_stopped are the (bytes/s, operations/s) budgets while the server runs and is stopped
+		if workers is not None:
+			self.__workers = workers
+		if low_priority is not None:
+			self.__low_priority = low_priority
+		self.__throttle.configure(io_running, io_stopped)
+		if gc_pause is not None:
+			self.__gc_pause = gc_pause
+		if on_error is not None:
+			self.__on_error = on_error
+		self.__cache.configure(cache_size, cache_memory)
+		if compression is not None:
+			self.__store.codec = codec_by_name(compression)
+		if hash_algorithm is not None:
+			self.__algo = hash_by_name(hash_algorithm)
+
+	@property
+	def algo(self):
+		return self.__algo
+
+	@property
+	def throttle(self):
+		return self.__throttle
+
+	@property
+	def on_error(self):
+		return self.__on_error
+
+	def new_pool(self):
+		# the workers only give way to the server while it runs
+		low = self.__low_priority and self.__throttle.running
+		return WorkerPool(self.__workers, initializer=lower_priority if low else None)
+
+	@property
+	def watcher(self):
+		return self.__watcher
+
+	def watch(self, base: str, needs: list):
+		self.unwatch()
+		if not DirtyWatcher.supported():
+			return False
+		w = DirtyWatcher(base, needs)
+		w.start()
+		self.__watcher = w
+		return True
+
+	def unwatch(self):
+		if self.__watcher is not None:
+			self.__watcher.stop()
+			self.__watcher = None
+		self.__watched = None
+
+	def _take_dirty(self, mode: BackupMode, prev: Backup, rehash: bool):
+		# An incremental backup only has to visit what changed since its previous backup,
+		# that is the last one saved while the watcher kept recording.
+		if self.__watcher is None:
+			return None
+		dirty = self.__watcher.take()
+		watched, self.__watched = self.__watched, None
+		if dirty is None or rehash or mode != BackupMode.INCREMENTAL or prev is None or prev.id != watched:
+			return None
+		return dirty
+
+	def _saved(self, bk: Backup):
+		if bk is self.__pending:
+			self.__pending = None
+			self.__watched = bk.id
+
+	def close(self):
+		# Wait for what holds the store, then stop the watcher and the collector.
+		# Another manager may use basepath afterwards, this one can only save its config anymore.
+		self.unwatch()
+		with self.__gc:
+			while self.__busy > 0:
+				self.__gc.wait()
+			self.__closed = True
+			self.__gc.notify_all()
+		self.wait_collected()
+		self.__store.close()
+		self.__index.close()
+
 	def _loadcfg(self):
 		self.__index.load(self.__basepath)
+		self.__statcache.load(self.__basepath)
+		if self.__index.missing_sizes():
+			# indexes written by older versions have no sizes
+			self.recount()
+			self.__index.commit()
+		trash = os.path.join(self.__basepath, TRASH_DIR)
+		if os.path.isdir(trash) and len(os.listdir(trash)) > 0: # left by the last run
+			self.collect()
 
 	def savecfg(self):
 		if not os.path.exists(self.__basepath):
 			os.makedirs(self.__basepath)
 			self.__index = BackupIndex()
 		self.__index.save(self.__basepath)
+		self.__statcache.save(self.__basepath)
 
 	def listID(self):
 		# return sorted(map(lambda a: int(a, 16), filter(lambda a: a.startswith('0x'), os.listdir(self.basepath))))
 		return self.index.list
 
-	def create(self, mode: BackupMode, comment: str, outdate: int, base: str, needs: list, ignores: list = [], saved: bool = True):
+	def create(self, mode: BackupMode, comment: str, outdate: int, base: str, needs: list, ignores: list = [], saved: bool = True,
+		*, rehash: bool = False, staged: bool = False):
+		# With staged, only the stat of every file is checked and changed files are copied into a staging
+		# directory, so the world can be saved again right after this returns. Hashing and storing them is
+		# left to Backup.save.
+		self._hold()
+		held = True
+		try:
+			bk = self._create(mode, comment, outdate, base, needs, ignores, rehash=rehash, staged=staged)
+			bk._held, held = True, False
+		finally:
+			if held:
+				self._unhold()
+		if saved:
+			bk.save()
+		return bk
+
+	def _create(self, mode: BackupMode, comment: str, outdate: int, base: str, needs: list, ignores: list,
+		*, rehash: bool, staged: bool):
 		prev: Backup = None
+		ref: Backup = None
 		if mode != BackupMode.FULL:
 			if self.index.last is None:
 				mode = BackupMode.FULL
 			else:
 				prev = self.load(self.index.last)
+		elif self.index.last is not None:
+			ref = self.load(self.index.last)
 
 		timestamp: int = int(time.time() * 1000)
-		files: set = set()
-		l = set(os.listdir(base))
-		if prev is not None:
-			if mode == BackupMode.DIFFERENTIAL:
-				while prev.mode != BackupMode.FULL:
-					prev = prev.prev
-			l.update(prev.get_total_files())
-		filterc = filters(ignores)
-		for n in filter(lambda a: a in needs, l):
-			m = os.path.join(base, n)
-			files.add((BackupDir if os.path.isdir(m) else BackupFile if os.path.exists(m) else prev.get(n).__class__).\
-				create(m, n, filterc=filterc, prev=prev))
-		if None in files:
-			files.remove(None)
-		bk = Backup(mode=mode, timestamp=timestamp, comment=comment, outdate=outdate, files=list(files), manager=self, prev=prev)
-		if saved:
-			bk.save()
+		files: dict
+		if prev is not None and mode == BackupMode.DIFFERENTIAL:
+			prev = self.load(self.index.root(prev.id))
+		statc = self.__statcache
+		if rehash:
+			statc.clear()
+		statc.begin()
+		written = self.__store.written
+		staging: str = None
+		if staged:
+			staging = os.path.join(self.__basepath, '.staging')
+			shutil.rmtree(staging, ignore_errors=True)
+		dirty = self._take_dirty(mode, prev, rehash)
+		self.__pending = None
+		with self.new_pool() as pool:
+			ctx = ScanContext(filters(ignores), store=self.__store, prev=prev, ref=ref, statc=statc, pool=pool, staging=staging, dirty=dirty,
+				algo=self.__algo)
+			files = ctx.scan(base, accept=lambda name, is_dir: name in needs)
+		bk = Backup(mode=mode, timestamp=timestamp, comment=comment, outdate=outdate, files=files, manager=self, prev=prev, algo=self.__algo)
+		bk._written = written
+		if self.__watcher is not None:
+			self.__pending = bk
+		if staged:
+			bk._pending = ctx
+		else:
+			bk._settle(ctx)
 		return bk
 
 	def load(self, bid: str, cached: bool = True):
-		if bid in self.__cache:
-			if cached:
-				return self.__cache[bid]
-			else:
-				self.__cache.pop(bid)
+		if cached:
+			bk = self.__cache.get(bid)
+			if bk is not None:
+				return bk
+		else:
+			self.__cache.pop(bid)
 
 		path: str = os.path.join(self.__basepath, bid)
 		if not os.path.exists(path):
 			raise BackupNotFoundError('Backup id {0} not found in "{1}"'.format(bid, self.__basepath))
-		mode: BackupMode
 		timestamp: int = int(bid, 16)
-		comment: str
-		outdate: int
-		files: list = []
-		previd: int
-		prev: Backup = None
-		with open(os.path.join(path, '0'), 'rb', 8192) as fd:
-			mode = BackupMode(int.from_bytes(fd.read(1), byteorder='big'))
-			previd = int.from_bytes(fd.read(8), byteorder='big')
-			outdate = int.from_bytes(fd.read(8), byteorder='big')
-			comment = fd.read(int.from_bytes(fd.read(2), byteorder='big')).decode('utf8')
+		mode, previd, outdate, comment, version, algo = _read_header(path)
 		if previd != 0:
 			assert previd != timestamp
+
+		loader = functools.partial(self._load_manifest, path, algo) if version >= 3 else functools.partial(self._load_tree, path, version)
+		bk = Backup(mode=mode, timestamp=timestamp, comment=comment, outdate=outdate, safety=True, manager=self, prev=None if previd == 0 else hex(previd),
+			loader=loader, algo=algo)
+		self.__cache.put(bk)
+		return bk
+
+	def _load_tree(self, path: str, version: int):
+		files: list = []
 		for n in os.listdir(path):
 			f = os.path.join(path, n)
 			e = os.path.splitext(f)[1]
 			if e == '.F':
-				files.append(BackupFile.load(f))
+				files.append(BackupFile.load(f, version, self.__store))
 			elif e == '.D':
-				files.append(BackupDir.load(f))
+				files.append(BackupDir.load(f, version, self.__store))
+		return files
+
+	def _load_manifest(self, path: str, algo: int = HASH_SHA256):
+		root: dict = {}
+		dirs: dict = {(): root}
+		with open(os.path.join(path, 'manifest'), 'rb', 1024 * 64) as fd:
+			while True:
+				pt = _read_path(fd)
+				if pt is None:
+					break
+				kind = fd.read(1)
+				f = (BackupDir if kind == b'D' else BackupFile).read(fd, pt[-1], self.__store, algo)
+				dirs[pt[:-1]][f.name] = f
+				if isinstance(f, BackupDir):
+					dirs[pt] = f._files
+		return list(root.values())
+
+	def _usage(self, bid: str):
+		# the logical size, the size of the files in the backup directory and the chunk keys of a backup
+		path = os.path.join(self.__basepath, bid)
+		logical: int = 0
+		keys: set = set()
+		mf = os.path.join(path, 'manifest')
+		if os.path.exists(mf):
+			for size, chunks in _read_manifest_files(mf):
+				logical += size
+				keys.update(chunks)
+			return logical, _dir_size(path), keys
+		own = _dir_size(path)
+		for f in self.load(bid).walk_files():
+			if f.type == ModifiedType.REMOVE:
+				continue
+			if f.chunks is None: # version 1 keeps the data in the .F files
+				return own, own, keys
+			logical += f.size
+			keys.update(f.chunks)
+		return logical, own, keys
+
+	def _usage_of(self, bid: str, stale=None):
+		if stale is None:
+			return self._usage(bid)
+		if stale():
+			return None
+		try:
+			return self._usage(bid)
+		except FileNotFoundError: # removed while it was read
+			if stale():
+				return None
+			raise
 
-		bk = Backup(mode=mode, timestamp=timestamp, comment=comment, outdate=outdate, files=files, safety=True, manager=self, prev=None if previd == 0 else hex(previd))
-		self.__cache[bid] = bk
-		return bk
+	@_holding
+	def remove(self, bk: Backup):
+		# Drop bk and the backups depending on it from the index and move them into the trash,
+		# the collector deletes them and the objects only they referenced later.
+		ids: list = self.index.remove(bk)
+		self.index.commit()
+		trash = os.path.join(self.__basepath, TRASH_DIR)
+		os.makedirs(trash, exist_ok=True)
+		for d in ids:
+			self.__cache.pop(d)
+			os.rename(os.path.join(self.__basepath, d), os.path.join(trash, '{}.{}'.format(d, os.urandom(4).hex())))
+		self.collect()
+		return ids
+
+	def _hold(self):
+		with self.__gc:
+			self.__busy += 1
+			self.__holds += 1
+			while self.__collecting:
+				self.__gc.wait()
+
+	def _unhold(self):
+		with self.__gc:
+			self.__busy -= 1
+			self.__gc.notify_all()
+
+	def collect(self):
+		# start the collector, or make it run once more when it's already running
+		with self.__gc:
+			self.__collect = True
+			if self.__collector is None and not self.__closed:
+				self.__collector = threading.Thread(target=self._run_collector, name='smart_backup_collector', daemon=True)
+				self.__collector.start()
+
+	def wait_collected(self):
+		t = self.__collector
+		if t is not None:
+			t.join()
+
+	def _run_collector(self):
+		lower_priority(idle=True)
+		while True:
+			with self.__gc:
+				if not self.__collect or self.__closed:
+					self.__collector = None
+					return
+				self.__collect = False
+			try:
+				self._empty_trash()
+				if not self.gc(stoppable=True):
+					with self.__gc:
+						self.__collect = True
+			except Exception as e:
+				if self.__on_error is None:
+					traceback.print_exc()
+				else:
+					self.__on_error(e)
+
+	def _empty_trash(self):
+		trash = os.path.join(self.__basepath, TRASH_DIR)
+		if not os.path.isdir(trash):
+			return
+		for n in os.listdir(trash):
+			if self.__closed:
+				return
+			shutil.rmtree(os.path.join(trash, n), ignore_errors=True)
+			time.sleep(self.__gc_pause)
+
+	def gc(self, *, stoppable: bool = False):
+		# Delete the objects no backup references. The manifests are read while others may use the store, only
+		# dropping objects and writing the sizes keep them waiting, and it reads them again when the store was held
+		# in between. With stoppable it steps back as soon as something holds the store and returns False.
+		stop = (lambda: self.__busy > 0 or self.__closed) if stoppable else None
+		while True:
+			with self.__gc:
+				while self.__busy > 0 and not self.__closed:
+					self.__gc.wait()
+				if self.__closed:
+					return False
+				holds = self.__holds
+			stale = lambda: self.__holds != holds or self.__closed
+			counts = self._counts(stale)
+			if counts is None or not self._begin_exclusive(holds):
+				continue
+			try:
+				self.__store.gc(counts, stop=stop, pause=self.__gc_pause if stoppable else 0)
+			finally:
+				self._end_exclusive()
+			if stop is not None and stop():
+				return False
+			sizes = self._sizes(counts, stale)
+			if sizes is None or not self._begin_exclusive(holds):
+				continue
+			try:
+				self._set_sizes(*sizes)
+				self.index.commit()
+			finally:
+				self._end_exclusive()
+			return True
+
+	def _begin_exclusive(self, holds: int):
+		# wait until nothing holds the store and keep it, False when it was held since holds was taken
+		with self.__gc:
+			while self.__busy > 0 and not self.__closed:
+				self.__gc.wait()
+			if self.__holds != holds or self.__closed:
+				return False
+			self.__collecting = True
+			return True
+
+	def _end_exclusive(self):
+		with self.__gc:
+			self.__collecting = False
+			self.__gc.notify_all()
+
+	def _counts(self, stale=None):
+		# how many backups reference each chunk, None when stale() tells the backups changed meanwhile
+		counts: dict = {}
+		for bid in self.index.list:
+			usage = self._usage_of(bid, stale)
+			if usage is None:
+				return None
+			for k in usage[2]:
+				counts[k] = counts.get(k, 0) + 1
+		return counts
+
+	def _sizes(self, counts: dict, stale=None):
+		# the unique size of a backup is its own files plus the chunks no other backup references
+		sizes: dict = {}
+		total: int = 0
+		for bid in self.index.list:
+			usage = self._usage_of(bid, stale)
+			if usage is None:
+				return None
+			logical, own, keys = usage
+			sizes[bid] = (logical, own + sum(self.__store.size(k) for k in keys if counts.get(k, 0) <= 1))
+			total += own
+		return sizes, total
+
+	def _set_sizes(self, sizes: dict, own: int):
+		for bid, (logical, unique) in sizes.items():
+			self.index.set_size(bid, logical, unique)
+		self.index.total = own + self.__store.disk_size()
+
+	def recount(self, counts: dict = None):
+		if counts is None:
+			counts = self._counts()
+		self._set_sizes(*self._sizes(counts))
+
+	@_holding
+	def consolidate(self, bk: Backup):
+		# Rewrite bk into a full backup with the same content, using only what is already stored.
+		# The backups depending on it keep their prev id, and its old chain isn't needed by them anymore.
+		if bk.mode == BackupMode.FULL:
+			return False
+		path = os.path.join(self.__basepath, bk.id)
+		tmp, old = path + '.tmp', path + '.old'
+		files = _full_tree(bk.manifest)
+		if any(f.algo != bk.algo for n in files.values() for f in n.walk_files()):
+			return False # the chain was hashed with different algorithms, the next full backup ends it anyway
+		with self.new_pool() as pool:
+			for fut in [pool.submit(f.save_data, self.__store) for n in files.values() for f in n.walk_files()]:
+				fut.result()
+		self.__store.flush()
+		own = _dir_size(path)
+		shutil.rmtree(tmp, ignore_errors=True)
+		os.mkdir(tmp)
+		with bk._lock:
+			state = bk._mode, bk._prev, bk._files, bk._loader
+			bk._mode, bk._prev, bk._files, bk._loader = BackupMode.FULL, None, files, None
+			bk._cost = None
+			try:
+				bk._save_header(os.path.join(tmp, '0'))
+				bk._save_manifest(os.path.join(tmp, 'manifest'))
+				os.rename(path, old)
+				os.rename(tmp, path)
+			except:
+				bk._mode, bk._prev, bk._files, bk._loader = state
+				shutil.rmtree(tmp, ignore_errors=True)
+				raise
+		shutil.rmtree(old)
+		self.index.promote(bk)
+		s = self.index.size_of(bk.id)
+		logical, own2, _ = self._usage(bk.id)
+		unique = own2 + (0 if s is None else s[1] - own)
+		self.index.set_size(bk.id, logical, unique)
+		self.index.total += own2 - own
+		self.index.commit()
+		return True
+
+	@_holding
+	def migrate(self, callback=None):
+		# rewrite the backups saved by older versions into the manifest format and move loose objects into packs
+		count: int = 0
+		for bid in self.index.list:
+			path = os.path.join(self.__basepath, bid)
+			bk = self.load(bid)
+			legacy = not os.path.exists(os.path.join(path, 'manifest'))
+			if legacy:
+				with self.new_pool() as pool:
+					for fut in [pool.submit(f.save_data, self.__store) for f in bk.walk_files()]:
+						fut.result()
+				self.__store.flush()
+				bk._save_manifest(os.path.join(path, 'manifest.tmp'))
+				bk._save_header(os.path.join(path, '0.tmp'))
+				os.replace(os.path.join(path, 'manifest.tmp'), os.path.join(path, 'manifest'))
+				os.replace(os.path.join(path, '0.tmp'), os.path.join(path, '0'))
+				count += 1
+			# also clean up what an interrupted migration left behind
+			for n in os.listdir(path):
+				if n not in ('0', 'manifest'):
+					p = os.path.join(path, n)
+					if os.path.isdir(p):
+						shutil.rmtree(p)
+					else:
+						os.remove(p)
+			if legacy and callback is not None:
+				callback(bk)
+		moved = self.__store.pack_loose()
+		# the data files of the converted backups are gone and their objects are shared now
+		self.recount()
+		self.index.commit()
+		return count, moved
 
 	def list(self, limit: int = -1):
 		if not os.path.exists(self.basepath):
@@ -636,92 +1787,162 @@ class BackupManager:
 		return self.load(self.index.last)
 
 
-def _filter(ignore: str):
-	if len(ignore) == 0:
-		return lambda *a, **b: True
-	f = []
-	if ignore[0] == '/':
-		dr, ignore = os.path.split(ignore[1:])
-		f.append(lambda path, base: path == dr)
-	elif '/' in ignore:
-		dr, ignore = os.path.split(ignore[1:])
-		f.append(lambda path, base: path.endswith(dr))
-	if ignore[0] == '*':
-		ignore = ignore[1:]
-		f.append(lambda path, base: base.endswith(ignore))
-	else:
-		f.append(lambda path, base: base == ignore)
-	def c(path: str, base: str):
-		for x in f:
-			if not x(path, base):
-				return False
-		return True
-	return c
+def _write_path(fd, pt: tuple):
+	b = '/'.join(pt).encode('utf8', 'surrogateescape')
+	fd.write(len(b).to_bytes(2, byteorder='big'))
+	fd.write(b)
+
+def _read_path(fd):
+	b = fd.read(2)
+	if not b:
+		return None
+	# names repeat in every backup, share one string for each of them
+	return tuple(map(sys.intern, fd.read(int.from_bytes(b, byteorder='big')).decode('utf8', 'surrogateescape').split('/')))
+
+def _read_header(path: str):
+	with open(os.path.join(path, '0'), 'rb', 8192) as fd:
+		mode = BackupMode(int.from_bytes(fd.read(1), byteorder='big'))
+		previd = int.from_bytes(fd.read(8), byteorder='big')
+		outdate = int.from_bytes(fd.read(8), byteorder='big')
+		comment = fd.read(int.from_bytes(fd.read(2), byteorder='big')).decode('utf8')
+		version = int.from_bytes(fd.read(1) or b'\x01', byteorder='big')
+		algo = int.from_bytes(fd.read(1), byteorder='big') if version >= 4 else HASH_SHA256
+	return mode, previd, outdate, comment, version, algo
+
+def _full_tree(manifest: Manifest, pt: tuple = ()):
+	files: dict = {}
+	for n in manifest.children(pt):
+		f = manifest.get((*pt, n))
+		if isinstance(f, BackupDir):
+			f = BackupDir(type_=ModifiedType.UPDATE, name=n, mode=f.mode, files=_full_tree(manifest, (*pt, n)))
+		files[n] = f
+	return files
+
+def _read_manifest_files(path: str):
+	# yield (size, chunks) of every stored file in a manifest without building the tree
+	with open(path, 'rb', 1024 * 64) as fd:
+		while True:
+			pt = _read_path(fd)
+			if pt is None:
+				break
+			kind, type_ = fd.read(2)
+			if type_ == ModifiedType.REMOVE:
+				continue
+			fd.read(2)
+			if kind == ord('F'):
+				fd.read(32)
+				size = int.from_bytes(fd.read(8), byteorder='big')
+				n = int.from_bytes(fd.read(4), byteorder='big')
+				yield size, KeyList(fd.read(32 * n))
+
+def _dir_size(path: str):
+	size: int = 0
+	for root, _, files in os.walk(path):
+		for f in files:
+			size += os.stat(os.path.join(root, f)).st_size
+	return size
 
 def filters(ignores: list):
-	ignorec = []
-	for i, s in enumerate(ignores):
-		ignorec.append(_filter(s))
-	def call(path: str, base: str):
-		for c in ignorec:
-			if c(path, base):
-				return False
-		return True
-	return call
+	return IgnoreMatcher(ignores)
 
-def writetofile(src, dst):
-	if isinstance(src, (bytes, str)):
-		dst.write(src)
+def splitter_for(name: str):
+	return split_region if is_region_file(name) else split_fixed
+
+def prune_dir(path: str, manifest: Manifest, filterc, *pt):
+	# remove the entries under path that aren't in the manifest, ignored entries are kept
+	if not os.path.lexists(path):
 		return
-	if isinstance(src, io.IOBase):
-		while True:
-			b = src.read(8192)
-			if not b:
-				break
-			dst.write(b)
+	f = manifest.get(pt)
+	if not os.path.isdir(path) or os.path.islink(path):
+		if not isinstance(f, BackupFile):
+			os.remove(path)
 		return
-	raise TypeError(type(data))
-
-def calchash(data):
-	if isinstance(data, bytes):
-		return hashlib.sha256(data).digest()
-	if isinstance(data, io.IOBase):
-		h = hashlib.sha256()
-		while True:
-			d = data.read(8192)
-			if not d:
-				break
-			h.update(d)
-		return h.digest()
-	raise TypeError(type(data))
+	parent = '/'.join(pt)
+	with os.scandir(path) as it:
+		entries = list(it)
+	for e in entries:
+		if filterc(parent, e.name, e.is_dir(follow_symlinks=False)):
+			prune_dir(e.path, manifest, filterc, *pt, e.name)
+	if not isinstance(f, BackupDir):
+		try:
+			os.rmdir(path)
+		except OSError: # still has ignored entries
+			pass
+
+def restore_file(path: str, f: BackupFile, statc: StatCache = None, key: str = None, *, differential: bool = False,
+	throttle: IOThrottle = None):
+	if differential and same_file(path, f, statc, key, throttle):
+		if f.mode != 0 and os.stat(path).st_mode & 0o777 != f.mode:
+			os.chmod(path, f.mode)
+		return False
+	f.restore(path)
+	return True
+
+def same_file(path: str, f: BackupFile, statc: StatCache = None, key: str = None, throttle: IOThrottle = None):
+	try:
+		st = os.stat(path)
+	except FileNotFoundError:
+		return False
+	if not stat.S_ISREG(st.st_mode) or (f.size >= 0 and st.st_size != f.size):
+		return False
+	hash_ = None if statc is None else statc.get(key, st, f.algo)
+	if hash_ is None:
+		with open(path, 'rb', 0) as fd:
+			hash_ = file_hash(fd if throttle is None else throttle.reader(fd), f.algo, splitter_for(f.name))
+		if statc is not None:
+			statc.put(key, st, hash_, f.algo)
+	return hash_ == f.hash
+
+def swap_dirs(path: str, staging: str, aside: str, needs: list, ignores: list = []):
+	# Replace the needs under path with the ones prepared in staging, the replaced ones are moved into aside.
+	# Ignored entries aren't in a restored tree, so they are carried over from the live one.
+	filterc = filters(ignores)
+	os.makedirs(aside, exist_ok=True)
+	for n in needs:
+		live, new, old = os.path.join(path, n), os.path.join(staging, n), os.path.join(aside, n)
+		if os.path.lexists(live):
+			if os.path.isdir(new):
+				carry_ignored(live, new, filterc, n)
+			move_path(live, old)
+		if os.path.lexists(new):
+			os.rename(new, live)
+
+def carry_ignored(src: str, dst: str, filterc, *pt):
+	if not os.path.isdir(src) or os.path.islink(src) or not os.path.isdir(dst):
+		return
+	parent = '/'.join(pt)
+	with os.scandir(src) as it:
+		entries = list(it)
+	for e in entries:
+		d = os.path.join(dst, e.name)
+		if not filterc(parent, e.name, e.is_dir(follow_symlinks=False)):
+			if not os.path.lexists(d):
+				os.rename(e.path, d)
+		elif e.is_dir(follow_symlinks=False):
+			carry_ignored(e.path, d, filterc, *pt, e.name)
+
+def move_path(src: str, dst: str):
+	try:
+		os.rename(src, dst)
+	except OSError as err:
+		if err.errno != errno.EXDEV:
+			raise
+		shutil.move(src, dst)
 
-def clear_dir(path: str, filterc):
-	if not os.path.exists(path):
+def clear_dir(path: str, filterc, *pt):
+	# remove everything under path that isn't ignored, a directory left empty is removed too
+	if not os.path.lexists(path):
 		return
-	if not os.path.isdir(path):
+	if not os.path.isdir(path) or os.path.islink(path):
 		os.remove(path)
 		return
-	que = queue.SimpleQueue()
-	dirs = {}
-	for f in os.listdir(path):
-		que.put(os.path.join(path, f))
-	while not que.empty():
-		f = que.get_nowait()
-		if not filterc(f, os.path.basename(f)):
-			continue
-		if os.path.isdir(f):
-			ls = os.listdir(f)
-			if len(ls) == 0:
-				os.rmdir(f)
-			else:
-				dirs[f] = len(ls)
-				for i in ls:
-					que.put(os.path.join(f, i))
-		else:
-			os.remove(f)
-			d = os.path.dirname(f)
-			if d in dirs:
-				dirs[d] -= 1
-				if dirs[d] == 0:
-					dirs.pop(d)
-					os.rmdir(d)
+	parent = '/'.join(pt)
+	with os.scandir(path) as it:
+		entries = list(it)
+	for e in entries:
+		if filterc(parent, e.name, e.is_dir(follow_symlinks=False)):
+			clear_dir(e.path, filterc, *pt, e.name)
+	try:
+		os.rmdir(path)
+	except OSError: # still has ignored entries
+		pass
@@ -0,0 +1,78 @@
+
+import os
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+__all__ = [
+	'WorkerPool', 'resolve', 'lower_priority'
+]
+
+class WorkerPool:
+	def __init__(self, workers: int = 0, *, backlog: int = 0, name: str = 'smart_backup_worker', initializer=None):
+		self._executor = ThreadPoolExecutor(max_workers=workers if workers > 0 else None, thread_name_prefix=name, initializer=initializer)
+		# bound the queued tasks so a huge tree doesn't turn into a huge list of pending jobs
+		self._slots = threading.BoundedSemaphore(backlog if backlog > 0 else self._executor._max_workers * 4)
+
+	@property
+	def workers(self):
+		return self._executor._max_workers
+
+	def submit(self, call, *args, **kwargs):
+		self._slots.acquire()
+		try:
+			fut = self._executor.submit(call, *args, **kwargs)
+		except:
+			self._slots.release()
+			raise
+		fut.add_done_callback(lambda _: self._slots.release())
+		return fut
+
+	def shutdown(self, wait: bool = True):
+		self._executor.shutdown(wait=wait)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.shutdown()
+
+def resolve(f):
+	return f.result() if isinstance(f, Future) else f
+
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# ioprio_set has no wrapper in libc or os
+_SYS_IOPRIO_SET = {
+	'x86_64': 251,
+	'i386': 289, 'i686': 289,
+	'aarch64': 30, 'riscv64': 30,
+	'armv7l': 314, 'armv6l': 314,
+	'ppc64le': 273, 'ppc64': 273,
+	's390x': 282,
+}
+
+def lower_priority(idle: bool = False):
+	# Lower the cpu and disk priority of the calling thread. On linux every thread has its own,
+	# elsewhere this would slow down the whole server so nothing is done.
+	# idle only gets the disk when nobody else uses it, otherwise it's the lowest best effort level
+	if not sys.platform.startswith('linux'):
+		return
+	tid = threading.get_native_id()
+	try:
+		os.setpriority(os.PRIO_PROCESS, tid, 19)
+	except (AttributeError, OSError):
+		pass
+	import platform
+	nr = _SYS_IOPRIO_SET.get(platform.machine(), None)
+	if nr is None:
+		return
+	try:
+		import ctypes
+		libc = ctypes.CDLL(None, use_errno=True)
+		ioprio = (IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) if idle else (IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT) | 7
+		libc.syscall(nr, IOPRIO_WHO_PROCESS, tid, ioprio)
+	except (ImportError, OSError):
+		pass
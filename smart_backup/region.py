@@ -0,0 +1,75 @@
+
+from .fileio import *
+from .store import *
+
+__all__ = [
+	'SECTOR_SIZE', 'HEADER_SIZE', 'REGION_SUFFIXES', 'is_region_file', 'parse_locations', 'split_region'
+]
+
+SECTOR_SIZE = 4096
+HEADER_SIZE = SECTOR_SIZE * 2 # location table + timestamp table
+REGION_SUFFIXES = ('.mca', '.mcr')
+
+def is_region_file(name: str):
+	return name.endswith(REGION_SUFFIXES)
+
+def parse_locations(header: bytes):
+	spans = []
+	for i in range(0, SECTOR_SIZE, 4):
+		offset = int.from_bytes(header[i:i + 3], byteorder='big')
+		count = header[i + 3]
+		if count == 0:
+			continue
+		if offset * SECTOR_SIZE < HEADER_SIZE:
+			return None
+		spans.append((offset * SECTOR_SIZE, (offset + count) * SECTOR_SIZE))
+	spans.sort()
+	for i in range(1, len(spans)):
+		if spans[i][0] < spans[i - 1][1]:
+			return None
+	return spans
+
+def split_region(rd, chunk_size: int = CHUNK_SIZE):
+	# Split a region file into its two header tables, every chunk payload, and the
+	# padding/free space between them, so a changed chunk only produces new objects
+	# for itself and the timestamp table. Concatenating the pieces gives back the
+	# original bytes whether or not the header could be parsed.
+	# Like split_fixed, the yielded views share one buffer.
+	mv = get_buffer(max(chunk_size, HEADER_SIZE, 255 * SECTOR_SIZE))
+	n = read_full(rd, mv[:HEADER_SIZE])
+	if n < HEADER_SIZE:
+		if n > 0:
+			yield mv[:n]
+		return
+	spans = parse_locations(mv[:SECTOR_SIZE])
+	if spans is None:
+		spans = []
+	yield mv[:SECTOR_SIZE]
+	yield mv[SECTOR_SIZE:HEADER_SIZE]
+	pos: int = HEADER_SIZE
+	for start, end in spans:
+		if start > pos:
+			yield from _split_gap(rd, mv, start - pos, chunk_size)
+			pos = start
+		n = read_full(rd, mv[:end - start])
+		if n == 0:
+			return
+		pos += n
+		data = mv[:n]
+		m = 4 + int.from_bytes(data[:4], byteorder='big') if n >= 4 else 0
+		if 4 < m < n:
+			yield data[:m]
+			yield data[m:]
+		else:
+			yield data
+		if pos < end:
+			return
+	yield from split_fixed(rd, chunk_size)
+
+def _split_gap(rd, mv: memoryview, size: int, chunk_size: int):
+	while size > 0:
+		n = read_full(rd, mv[:min(size, chunk_size)])
+		if n == 0:
+			return
+		size -= n
+		yield mv[:n]
@@ -0,0 +1,506 @@
+
+import io
+import os
+import shutil
+import tempfile
+import time
+import threading
+
+from .fileio import *
+from .codec import *
+from .digest import *
+from .throttle import *
+
+__all__ = [
+	'CHUNK_SIZE', 'PACK_SIZE', 'split_fixed', 'KeyList', 'PackIndex', 'ObjectStore', 'ChunkReader'
+]
+
+CHUNK_SIZE = 1024 * 1024 # 1MB
+PACK_SIZE = 1024 * 1024 * 1024 # 1GB
+
+IDX_MAGIC = b'SMBI'
+IDX_VERSION = 2
+IDX_ENTRY_SIZES = {
+	1: 32 + 8 + 4, # key, offset, length
+	2: 32 + 8 + 4 + 1, # key, offset, length, codec
+}
+
+def split_fixed(rd, chunk_size: int = CHUNK_SIZE):
+	# the yielded views share one buffer, so they are only valid until the next one
+	mv = get_buffer(chunk_size)
+	while True:
+		n = read_full(rd, mv)
+		if n == 0:
+			break
+		yield mv[:n]
+
+class KeyList:
+	# a read-only sequence of 32 byte keys packed into one bytes object
+	__slots__ = ('_buf',)
+
+	def __init__(self, keys=b''):
+		self._buf = keys if isinstance(keys, bytes) else b''.join(keys)
+
+	@property
+	def raw(self):
+		return self._buf
+
+	def __len__(self):
+		return len(self._buf) // 32
+
+	def __getitem__(self, i: int):
+		n = len(self)
+		if i < 0:
+			i += n
+		if i < 0 or i >= n:
+			raise IndexError(i)
+		return self._buf[i * 32:i * 32 + 32]
+
+	def __iter__(self):
+		b = self._buf
+		for o in range(0, len(b), 32):
+			yield b[o:o + 32]
+
+	def __eq__(self, other):
+		return isinstance(other, KeyList) and self._buf == other._buf
+
+	def __hash__(self):
+		return hash(self._buf)
+
+class PackIndex:
+	# The sorted (key, offset, length, codec) table of a pack file. It's kept as one bytes object and
+	# searched in place, a fanout table on the first byte of the key narrows the range.
+	# Version 1 indexes have no codec, their objects are all stored raw.
+	def __init__(self, data: bytes = None):
+		self._count = 0
+		self._fanout = [0] * 257
+		self._table = b''
+		self._esize = IDX_ENTRY_SIZES[IDX_VERSION]
+		if data is not None:
+			if data[:4] != IDX_MAGIC or data[4] not in IDX_ENTRY_SIZES:
+				raise ValueError('Not a pack index')
+			self._esize = IDX_ENTRY_SIZES[data[4]]
+			self._count = int.from_bytes(data[5:9], byteorder='big')
+			self._table = data[9:]
+			if len(self._table) != self._count * self._esize:
+				raise ValueError('Broken pack index')
+			i = 0
+			for j in range(self._count):
+				b = self._table[j * self._esize]
+				while i <= b:
+					self._fanout[i] = j
+					i += 1
+			while i <= 256:
+				self._fanout[i] = self._count
+				i += 1
+
+	def __len__(self):
+		return self._count
+
+	def _key(self, i: int):
+		o = i * self._esize
+		return self._table[o:o + 32]
+
+	def _entry(self, i: int):
+		o = i * self._esize
+		return (self._table[o:o + 32],
+			int.from_bytes(self._table[o + 32:o + 40], byteorder='big'),
+			int.from_bytes(self._table[o + 40:o + 44], byteorder='big'),
+			self._table[o + 44] if self._esize > 44 else CODEC_NONE)
+
+	def find(self, key: bytes):
+		lo, hi = self._fanout[key[0]], self._fanout[key[0] + 1]
+		while lo < hi:
+			mid = (lo + hi) // 2
+			k = self._key(mid)
+			if k < key:
+				lo = mid + 1
+			elif k > key:
+				hi = mid
+			else:
+				return self._entry(mid)[1:]
+		return None
+
+	def entries(self):
+		for i in range(self._count):
+			yield self._entry(i)
+
+	@staticmethod
+	def encode(entries):
+		entries = sorted(entries)
+		b = bytearray(IDX_MAGIC)
+		b.append(IDX_VERSION)
+		b += len(entries).to_bytes(4, byteorder='big')
+		for k, o, l, c in entries:
+			b += k
+			b += o.to_bytes(8, byteorder='big')
+			b += l.to_bytes(4, byteorder='big')
+			b.append(c)
+		return bytes(b)
+
+	@classmethod
+	def load(cls, path: str):
+		with open(path, 'rb') as fd:
+			return cls(fd.read())
+
+class _PackWriter:
+	def __init__(self, path: str):
+		self.name = os.path.basename(path)
+		self.fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o666)
+		self.end = os.fstat(self.fd).st_size
+		self.pending = {}
+
+	def reserve(self, key: bytes, length: int, codec: int):
+		offset = self.end
+		self.end += length
+		self.pending[key] = (offset, length, codec)
+		return offset
+
+class ObjectStore:
+	# Objects are appended to large pack files, every pack has a sorted .idx written when the store is flushed.
+	# Objects written by older versions as loose files (hh/rest) are still readable.
+	# New objects are compressed with the configured codec when a probe says it's worth it,
+	# the codec is recorded per object so the setting can change at any time.
+	def __init__(self, path: str, codec: int = CODEC_NONE, throttle: IOThrottle = None):
+		self._path = path
+		self._codec = codec
+		self._throttle = IOThrottle() if throttle is None else throttle
+		self._lock = threading.Lock()
+		self._packs = None
+		self._fds = {}
+		self._writer = None
+		self._retired = []
+		self._loose = False
+		self._written = 0
+
+	@property
+	def path(self):
+		return self._path
+
+	@property
+	def codec(self):
+		return self._codec
+
+	@codec.setter
+	def codec(self, codec: int):
+		self._codec = codec
+
+	@property
+	def throttle(self):
+		return self._throttle
+
+	@property
+	def written(self):
+		# bytes of new objects appended since the store was opened
+		return self._written
+
+	def _objpath(self, key: bytes):
+		h = key.hex()
+		return os.path.join(self._path, h[:2], h[2:])
+
+	def _load_packs(self):
+		if self._packs is None:
+			with self._lock:
+				if self._packs is None:
+					packs = {}
+					if os.path.isdir(self._path):
+						for n in os.listdir(self._path):
+							if n.endswith('.idx'):
+								packs[n[:-4] + '.pack'] = PackIndex.load(os.path.join(self._path, n))
+							elif len(n) == 2 and os.path.isdir(os.path.join(self._path, n)):
+								self._loose = True
+					self._packs = packs
+		return self._packs
+
+	def _find(self, key: bytes):
+		packs = self._load_packs()
+		for w in (self._writer, *self._retired):
+			if w is not None and key in w.pending:
+				return (w.name, *w.pending[key])
+		for name, idx in packs.items():
+			e = idx.find(key)
+			if e is not None:
+				return (name, *e)
+		return None
+
+	def _rfd(self, name: str):
+		fd = self._fds.get(name, None)
+		if fd is None:
+			with self._lock:
+				fd = self._fds.get(name, None)
+				if fd is None:
+					fd = self._fds[name] = os.open(os.path.join(self._path, name), os.O_RDONLY)
+		return fd
+
+	def has(self, key: bytes):
+		if self._find(key) is not None:
+			return True
+		return self._loose and os.path.exists(self._objpath(key))
+
+	def put(self, key: bytes, data: bytes):
+		if self.has(key):
+			return False
+		return self._append(key, *encode_object(data, self._codec))
+
+	def _append(self, key: bytes, codec: int, data: bytes, *, force: bool = False):
+		with self._lock:
+			w = self._writer
+			if not force and w is not None and key in w.pending:
+				return False
+			if w is None or w.end >= PACK_SIZE:
+				if w is not None:
+					self._retired.append(w)
+				os.makedirs(self._path, exist_ok=True)
+				w = self._writer = _PackWriter(os.path.join(self._path, 'pack-{}.pack'.format(os.urandom(8).hex())))
+			offset = w.reserve(key, len(data), codec)
+			self._written += len(data)
+		self._throttle.io(len(data))
+		# each writer thread owns the range it reserved
+		write_full(w.fd, data, offset)
+		return True
+
+	def flush(self):
+		# make the written objects durable and visible in the pack indexes
+		packs = self._load_packs()
+		with self._lock:
+			writers = [*self._retired, self._writer]
+			self._retired = []
+			synced = False
+			for w in writers:
+				if w is None or len(w.pending) == 0:
+					continue
+				synced = True
+				os.fsync(w.fd)
+				idx = packs.get(w.name, None)
+				entries = [] if idx is None else list(idx.entries())
+				entries.extend((k, *e) for k, e in w.pending.items())
+				data = PackIndex.encode(entries)
+				path = os.path.join(self._path, w.name[:-5] + '.idx')
+				fd, tmp = tempfile.mkstemp(dir=self._path, suffix='.tmp')
+				try:
+					try:
+						write_full(fd, data)
+						os.fsync(fd)
+					finally:
+						os.close(fd)
+					os.replace(tmp, path)
+				except:
+					os.remove(tmp)
+					raise
+				packs[w.name] = PackIndex(data)
+				w.pending = {}
+			if synced: # new packs and the replaced indexes
+				fsync_dir(self._path)
+			for w in writers[:-1]:
+				os.close(w.fd)
+
+	def close_writer(self):
+		self.flush()
+		with self._lock:
+			if self._writer is not None:
+				os.close(self._writer.fd)
+				self._writer = None
+
+	def close(self):
+		self.close_writer()
+		with self._lock:
+			for fd in self._fds.values():
+				os.close(fd)
+			self._fds.clear()
+
+	def get(self, key: bytes):
+		with self.open(key) as fd:
+			return fd.read()
+
+	def open(self, key: bytes):
+		e = self._find(key)
+		if e is None:
+			return open(self._objpath(key), 'rb', 0)
+		name, offset, length, codec = e
+		if codec != CODEC_NONE:
+			self._throttle.io(length)
+			return io.BytesIO(decompress(os.pread(self._rfd(name), length, offset), codec))
+		return self._throttle.reader(_RangeReader(self._rfd(name), offset, length))
+
+	def copy_to(self, key: bytes, fd: int):
+		e = self._find(key)
+		if e is None:
+			with open(self._objpath(key), 'rb', 0) as rd:
+				n = copy_range(rd.fileno(), fd)
+			self._throttle.io(n * 2, 2)
+			return n
+		name, offset, length, codec = e
+		if codec != CODEC_NONE:
+			self._throttle.io(length)
+			data = decompress(os.pread(self._rfd(name), length, offset), codec)
+			self._throttle.io(len(data))
+			write_full(fd, data)
+			return len(data)
+		# the read and the write of the copy
+		self._throttle.io(length * 2, 2)
+		return copy_range(self._rfd(name), fd, length, offset)
+
+	def size(self, key: bytes):
+		# the stored size, which is smaller than the data for compressed objects
+		e = self._find(key)
+		if e is None:
+			return os.stat(self._objpath(key)).st_size
+		return e[2]
+
+	def disk_size(self):
+		size: int = 0
+		if os.path.isdir(self._path):
+			for root, _, files in os.walk(self._path):
+				for f in files:
+					size += os.stat(os.path.join(root, f)).st_size
+		return size
+
+	def put_stream(self, rd, splitter=split_fixed, algo: int = HASH_SHA256):
+		h = FileHasher(algo)
+		size: int = 0
+		chunks: list = []
+		for b in splitter(self._throttle.reader(rd)):
+			key = h.key(b)
+			h.update(b, key)
+			size += len(b)
+			self.put(key, b)
+			chunks.append(key)
+		return h.digest(), size, KeyList(chunks)
+
+	def loose_keys(self):
+		if not os.path.isdir(self._path):
+			return
+		for d in os.listdir(self._path):
+			p = os.path.join(self._path, d)
+			if len(d) != 2 or not os.path.isdir(p):
+				continue
+			for n in os.listdir(p):
+				if n.endswith('.tmp'):
+					continue
+				try:
+					yield bytes.fromhex(d + n)
+				except ValueError:
+					pass
+
+	def keys(self):
+		for idx in list(self._load_packs().values()):
+			for k, *_ in idx.entries():
+				yield k
+		yield from self.loose_keys()
+
+	def pack_loose(self):
+		# move the loose objects written by older versions into packs
+		self._load_packs()
+		count: int = 0
+		keys = list(self.loose_keys())
+		for k in keys:
+			if self._find(k) is None:
+				with open(self._objpath(k), 'rb') as fd:
+					self._append(k, *encode_object(fd.read(), self._codec))
+				count += 1
+		self.flush()
+		for k in keys:
+			os.remove(self._objpath(k))
+		for d in os.listdir(self._path):
+			p = os.path.join(self._path, d)
+			if len(d) == 2 and os.path.isdir(p):
+				shutil.rmtree(p, ignore_errors=True)
+		self._loose = False
+		return count
+
+	def _drop_pack(self, name: str):
+		with self._lock:
+			self._packs.pop(name, None)
+			fd = self._fds.pop(name, None)
+			if fd is not None:
+				os.close(fd)
+		os.remove(os.path.join(self._path, name[:-5] + '.idx'))
+		os.remove(os.path.join(self._path, name))
+
+	def gc(self, live, *, stop=None, pause: float = 0):
+		# live only needs to support `in`, packs with no live object are deleted
+		# and packs that are mostly dead are rewritten. stop is checked between packs,
+		# the packs handled until then are still collected
+		self.close_writer()
+		count: int = 0
+		free: int = 0
+		drops: list = []
+		for name, idx in list(self._load_packs().items()):
+			if stop is not None and stop():
+				break
+			alive, dead = [], []
+			for e in idx.entries():
+				(alive if e[0] in live else dead).append(e)
+			if len(dead) == 0:
+				continue
+			dsize = sum(e[2] for e in dead)
+			if len(alive) > 0:
+				if dsize < sum(e[2] for e in alive):
+					continue
+				fd = self._rfd(name)
+				for k, o, l, c in alive:
+					self._append(k, c, os.pread(fd, l, o), force=True)
+				if pause > 0:
+					time.sleep(pause)
+			drops.append(name)
+			count += len(dead)
+			free += dsize
+		# the rewritten objects must be durable before their old packs go away
+		self.close_writer()
+		for name in drops:
+			self._drop_pack(name)
+		if self._loose:
+			for k in list(self.loose_keys()):
+				if k not in live:
+					p = self._objpath(k)
+					free += os.stat(p).st_size
+					os.remove(p)
+					count += 1
+		return count, free
+
+class _RangeReader(io.RawIOBase):
+	def __init__(self, fd: int, offset: int, length: int):
+		super().__init__()
+		self._fd = fd
+		self._offset = offset
+		self._end = offset + length
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		n = min(len(b), self._end - self._offset)
+		if n <= 0:
+			return 0
+		n = os.preadv(self._fd, [memoryview(b)[:n]], self._offset)
+		self._offset += n
+		return n
+
+class ChunkReader(io.RawIOBase):
+	def __init__(self, store: ObjectStore, chunks: list):
+		super().__init__()
+		self._store = store
+		self._chunks = chunks
+		self._index = 0
+		self._current = None
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		while self._index < len(self._chunks):
+			if self._current is None:
+				self._current = self._store.open(self._chunks[self._index])
+			n = self._current.readinto(b)
+			if n:
+				return n
+			self._current.close()
+			self._current = None
+			self._index += 1
+		return 0
+
+	def close(self):
+		if self._current is not None:
+			self._current.close()
+			self._current = None
+		super().close()
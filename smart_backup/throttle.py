@@ -0,0 +1,97 @@
+
+import io
+import time
+import threading
+
+__all__ = [
+	'TokenBucket', 'IOThrottle'
+]
+
+class TokenBucket:
+	# rate tokens per second with up to one second of burst, 0 means no limit.
+	# A take larger than the tokens left goes into debt and sleeps it off, so big chunks still work.
+	def __init__(self, rate: float = 0):
+		self._lock = threading.Lock()
+		self._rate = 0
+		self._tokens = 0
+		self._stamp = time.monotonic()
+		self.configure(rate)
+
+	@property
+	def rate(self):
+		return self._rate
+
+	def configure(self, rate: float):
+		with self._lock:
+			self._rate = max(rate, 0)
+			self._tokens = min(self._tokens, self._rate)
+			self._stamp = time.monotonic()
+
+	def take(self, n: float):
+		if self._rate <= 0:
+			return
+		with self._lock:
+			now = time.monotonic()
+			self._tokens = min(self._rate, self._tokens + (now - self._stamp) * self._rate)
+			self._stamp = now
+			self._tokens -= n
+			wait = -self._tokens / self._rate
+		if wait > 0:
+			time.sleep(wait)
+
+class IOThrottle:
+	# The I/O budget shared by every backup reader and writer, in bytes and operations per second.
+	# There is one budget while the server runs and one while it's stopped.
+	def __init__(self):
+		self._bytes = TokenBucket()
+		self._ops = TokenBucket()
+		self._limits = {True: (0, 0), False: (0, 0)}
+		self._running = True
+
+	@property
+	def running(self):
+		return self._running
+
+	@running.setter
+	def running(self, running: bool):
+		self._running = running
+		self._apply()
+
+	@property
+	def limited(self):
+		return self._bytes.rate > 0 or self._ops.rate > 0
+
+	def configure(self, running: tuple = None, stopped: tuple = None):
+		# (bytes per second, operations per second)
+		if running is not None:
+			self._limits[True] = running
+		if stopped is not None:
+			self._limits[False] = stopped
+		self._apply()
+
+	def _apply(self):
+		rate, ops = self._limits[self._running]
+		self._bytes.configure(rate)
+		self._ops.configure(ops)
+
+	def io(self, n: int, ops: int = 1):
+		self._ops.take(ops)
+		self._bytes.take(n)
+
+	def reader(self, rd):
+		return _ThrottledReader(rd, self) if self.limited else rd
+
+class _ThrottledReader(io.RawIOBase):
+	def __init__(self, rd, throttle: IOThrottle):
+		super().__init__()
+		self._rd = rd
+		self._throttle = throttle
+
+	def readable(self):
+		return True
+
+	def readinto(self, b):
+		n = self._rd.readinto(b)
+		if n:
+			self._throttle.io(n)
+		return n
@@ -1,5 +1,4 @@
 
-import os
 from threading import RLock, Condition, Timer
 import functools
 
@@ -9,8 +8,8 @@ from . import globals as GL
 __all__ = [
 	'new_thread', 'tr',
 	'get_current_job', '_clear_job', 'after_job_wrapper', 'ping_job', 'after_job', 'swap_job_call', 'new_job', 'new_timer',
-	'new_command', 'join_rtext', 'send_block_message', 'send_message', 'broadcast_message', 'log_info',
-	'get_total_size', 'format_size'
+	'new_command', 'join_rtext', 'send_block_message', 'send_message', 'broadcast_message', 'log_info', 'log_error',
+	'format_size'
 ]
 
 def new_thread(call):
@@ -148,12 +147,8 @@ def broadcast_message(*args, sep=' ', prefix=GL.MSG_ID):
 def log_info(*args, sep=' ', prefix=GL.MSG_ID):
 	MCDR.ServerInterface.get_instance().logger.info(join_rtext(prefix, *args, sep=sep))
 
-def get_total_size(path: str):
-	size = 0
-	for root, _, files in os.walk(path):
-		for f in files:
-			size += os.stat(os.path.join(root, f)).st_size
-	return size
+def log_error(*args, sep=' ', prefix=GL.MSG_ID, exc_info=None):
+	MCDR.ServerInterface.get_instance().logger.error(join_rtext(prefix, *args, sep=sep), exc_info=exc_info)
 
 __bt_units = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
 
@@ -0,0 +1,239 @@
+
+import os
+import sys
+import errno
+import select
+import struct
+import threading
+
+__all__ = [
+	'DirtySet', 'DirtyWatcher'
+]
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |\
+	IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+def _load_libc():
+	global _libc
+	if _libc is None:
+		import ctypes, ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+		libc.inotify_init1.argtypes = [ctypes.c_int]
+		libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+		libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+		_libc = libc
+	return _libc
+
+def _check(ret: int, what: str):
+	if ret < 0:
+		import ctypes
+		err = ctypes.get_errno()
+		raise OSError(err, '{}: {}'.format(what, os.strerror(err)))
+	return ret
+
+class DirtySet:
+	# The directories whose entries changed (dirs) and the ones that are new as a whole (deep), as path tuples
+	# relative to the watched base. Ancestors of both are the only directories a scan has to descend into.
+	def __init__(self, dirs: set, deep: set):
+		self._dirs = dirs
+		self._deep = deep
+		self._tree = {}
+		for pt in (*dirs, *deep):
+			for i in range(len(pt)):
+				self._tree.setdefault(pt[:i], set()).add(pt[i])
+			self._tree.setdefault(pt, set())
+
+	def __len__(self):
+		return len(self._dirs) + len(self._deep)
+
+	def is_deep(self, pt: tuple):
+		for i in range(len(pt) + 1):
+			if pt[:i] in self._deep:
+				return True
+		return False
+
+	def is_dirty(self, pt: tuple):
+		return pt in self._dirs or self.is_deep(pt)
+
+	def skipped(self, pt: tuple):
+		return pt not in self._tree and not self.is_deep(pt)
+
+	def children(self, pt: tuple):
+		return self._tree.get(pt, ())
+
+class DirtyWatcher:
+	# Records the changed directories under base/needs with inotify between backups.
+	# take returns None when the changes may be incomplete (queue overflow, a root was replaced or is watched
+	# only since this take, the watcher was just started), then the caller has to scan everything.
+	def __init__(self, base: str, needs: list):
+		self._base = base
+		self._needs = list(needs)
+		self._lock = threading.Lock()
+		self._fd = -1
+		self._pipe = None
+		self._thread = None
+		self._wds = {}
+		self._dirs = set()
+		self._deep = set()
+		self._valid = False
+
+	@staticmethod
+	def supported():
+		return sys.platform.startswith('linux')
+
+	def start(self):
+		if self._thread is not None:
+			return
+		libc = _load_libc()
+		self._fd = _check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC), 'inotify_init1')
+		try:
+			self._add_roots()
+		except:
+			os.close(self._fd)
+			self._fd = -1
+			raise
+		self._pipe = os.pipe()
+		self._valid = False
+		self._thread = threading.Thread(target=self._run, name='smart_backup_watcher', daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		t = self._thread
+		if t is None:
+			return
+		os.write(self._pipe[1], b'\0')
+		t.join()
+		self._thread = None
+		for fd in (self._fd, *self._pipe):
+			os.close(fd)
+		self._fd = -1
+		self._pipe = None
+		with self._lock:
+			self._wds.clear()
+			self._invalidate()
+
+	def take(self):
+		# the changes since the last take, and start recording the next ones
+		with self._lock:
+			if self._thread is not None:
+				# the events of the writes before this call are queued already, but maybe not read yet
+				self._drain()
+				try:
+					if self._add_roots(): # nothing was recorded for them until now
+						self._invalidate()
+				except OSError:
+					self._invalidate()
+			res = DirtySet(self._dirs, self._deep) if self._valid else None
+			self._dirs = set()
+			self._deep = set()
+			self._valid = self._thread is not None
+			return res
+
+	def _invalidate(self):
+		self._valid = False
+		self._dirs = set()
+		self._deep = set()
+
+	def _add_roots(self):
+		# watch the roots that (re)appeared since they were last watched
+		watched = {pt[0] for pt in self._wds.values() if len(pt) == 1}
+		added = False
+		for n in self._needs:
+			p = os.path.join(self._base, n)
+			if n not in watched and os.path.isdir(p):
+				self._add_tree(p, (n,))
+				added = True
+		return added
+
+	def _add_tree(self, path: str, pt: tuple):
+		libc = _load_libc()
+		try:
+			wd = _check(libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK), 'inotify_add_watch')
+		except OSError as e:
+			if e.errno in (errno.ENOENT, errno.ENOTDIR):
+				return
+			raise
+		self._wds[wd] = pt
+		with os.scandir(path) as it:
+			for e in it:
+				if e.is_dir(follow_symlinks=False):
+					self._add_tree(e.path, (*pt, e.name))
+
+	def _drop_tree(self, pt: tuple):
+		libc = _load_libc()
+		for wd, p in list(self._wds.items()):
+			if p[:len(pt)] == pt:
+				libc.inotify_rm_watch(self._fd, wd)
+				self._wds.pop(wd)
+
+	def _run(self):
+		while True:
+			r, _, _ = select.select([self._fd, self._pipe[0]], [], [])
+			if self._pipe[0] in r:
+				return
+			with self._lock:
+				self._drain()
+
+	def _drain(self):
+		# handle every queued event, the lock is held so take can't miss what was read but not handled yet
+		while True:
+			try:
+				data = os.read(self._fd, 64 * 1024)
+			except BlockingIOError:
+				return
+			try:
+				self._handle(data)
+			except OSError: # most likely out of watches, nothing can be trusted anymore
+				self._invalidate()
+
+	def _handle(self, data: bytes):
+		o = 0
+		while o < len(data):
+			wd, mask, _, n = _EVENT.unpack_from(data, o)
+			name = os.fsdecode(data[o + _EVENT.size:o + _EVENT.size + n].rstrip(b'\0'))
+			o += _EVENT.size + n
+			if mask & IN_Q_OVERFLOW:
+				self._invalidate()
+				continue
+			pt = self._wds.get(wd, None)
+			if mask & IN_IGNORED:
+				self._wds.pop(wd, None)
+				continue
+			if pt is None:
+				continue
+			if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+				if len(pt) == 1: # a backup root itself was replaced, the next take watches the new one
+					self._drop_tree(pt)
+					self._invalidate()
+				continue
+			if len(name) == 0:
+				continue
+			self._dirs.add(pt)
+			if mask & IN_ISDIR:
+				c = (*pt, name)
+				if mask & IN_MOVED_FROM:
+					self._drop_tree(c)
+				elif mask & (IN_CREATE | IN_MOVED_TO):
+					self._deep.add(c)
+					self._add_tree(os.path.join(self._base, *c), c)